@@ -0,0 +1,87 @@
+"""Offline check of the Notion events route, no Redis, Telegram or running service needed.
+
+Feeds signed and unsigned events to `NotionEvents.handle_event` backed by an in-memory storage.
+
+    python -m app.check_notion_events
+"""
+import asyncio
+import json
+from typing import Optional
+
+from app.notion_events import NotionEvents, sign_event
+from app.send_notion_event import make_page_event
+
+SECRET = 'secret'
+DB_ID = 'db'
+PAGE_ID = 'page'
+
+
+class InMemoryStorage:
+    """The part of `app.storage.Storage` the events route uses."""
+
+    def __init__(self, subscribed_db_ids: set[str]):
+        self.subscribed_db_ids = subscribed_db_ids
+        self.dirty_page_ids: dict[str, set[str]] = {}
+        self.poll_schedule: dict[str, float] = {}
+        self.verification_token: Optional[str] = None
+
+    async def has_db_subscribers(self, db_id: str) -> bool:
+        return db_id in self.subscribed_db_ids
+
+    async def add_db_dirty_page_ids(self, db_id: str, page_ids: list[str]) -> None:
+        self.dirty_page_ids.setdefault(db_id, set()).update(page_ids)
+
+    async def set_db_poll_schedule(self, db_id: str, due_at: float, interval: float) -> None:
+        self.poll_schedule[db_id] = due_at
+
+    async def set_notion_events_verification_token(self, token: str) -> None:
+        self.verification_token = token
+
+
+class EventRequest:
+    """Stands in for the aiohttp request, the route only reads its body and headers."""
+
+    def __init__(self, event: dict, secret: Optional[str] = None):
+        self.body = json.dumps(event).encode('utf-8')
+        self.headers = {'X-Notion-Signature': sign_event(secret, self.body)} if secret else {}
+
+    async def read(self) -> bytes:
+        return self.body
+
+
+async def send(notion_events: NotionEvents, event: dict, secret: Optional[str] = None) -> int:
+    response = await notion_events.handle_event(EventRequest(event, secret))
+    return response.status
+
+
+async def check() -> None:
+    storage = InMemoryStorage({DB_ID})
+    unverified = NotionEvents(storage, secret='')
+    assert await send(unverified, {'verification_token': 'secret_token'}) == 200
+    assert storage.verification_token == 'secret_token'
+    assert await send(unverified, make_page_event(DB_ID, PAGE_ID, 'page.created')) == 403
+
+    notion_events = NotionEvents(storage, secret=SECRET)
+    page_event = make_page_event(DB_ID, PAGE_ID, 'page.properties_updated')
+    assert await send(notion_events, page_event) == 401
+    assert await send(notion_events, page_event, 'wrong secret') == 401
+    assert not storage.dirty_page_ids
+
+    other_db_event = make_page_event('other db', 'other page', 'page.created')
+    assert await send(notion_events, other_db_event, SECRET) == 200
+    comment_event = {**page_event, 'type': 'comment.created'}
+    assert await send(notion_events, comment_event, SECRET) == 200
+    assert not storage.dirty_page_ids
+
+    assert await send(notion_events, page_event, SECRET) == 200
+    assert storage.dirty_page_ids == {DB_ID: {PAGE_ID}}
+    assert DB_ID in storage.poll_schedule
+
+
+def main() -> None:
+    asyncio.run(check())
+    print('Notion events route is OK')
+
+
+if __name__ == '__main__':
+    main()
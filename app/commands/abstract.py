@@ -1,14 +1,14 @@
 from __future__ import annotations
 from typing import Optional
 
-from aiogram import Bot
 from aiogram.types import Message
 
 from app.storage import Storage
+from app.telegram import TelegramQueue
 
 
 class AbstractCommand:
-    def __init__(self, bot: Bot, next: Optional['AbstractCommand'], storage: Storage):
+    def __init__(self, bot: TelegramQueue, next: Optional['AbstractCommand'], storage: Storage):
         self._bot = bot
         self._next = next
         self._storage = storage
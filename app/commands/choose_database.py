@@ -1,6 +1,5 @@
 from typing import Any, Final
 
-from aiogram import Bot
 from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
@@ -11,7 +10,9 @@ from aiogram.utils.callback_data import CallbackData
 
 from app.commands.abstract import AbstractCommand
 from app.storage import Storage
-from app.notion import NotionClient
+from app.notion import AsyncNotionClient
+from app.telegram import TelegramQueue
+from app.tracker.schedule import wake_db_poll
 
 ChooseDatabaseCallback: Final[CallbackData] = CallbackData("choose_db", "db_id", "db_title")
 
@@ -21,10 +22,10 @@ class ChooseDatabaseCommand(AbstractCommand):
 
     def __init__(
         self,
-        bot: Bot,
+        bot: TelegramQueue,
         next: AbstractCommand,
         storage: Storage,
-        notion: NotionClient,
+        notion: AsyncNotionClient,
     ):
         super().__init__(bot, next, storage)
         self._notion = notion
@@ -38,9 +39,10 @@ class ChooseDatabaseCommand(AbstractCommand):
 
     async def execute(self, message: Message) -> None:
         chat_id = message.chat.id
-        access_token = await self._storage.get_user_access_token(chat_id)
-        user_notion = self._notion(auth=access_token)
-        databases = user_notion.list_databases()
+        profile = await self._storage.get_user_profile(chat_id)
+        access_token = profile.access_token
+        async with self._notion(auth=access_token) as user_notion:
+            databases = await user_notion.list_databases()
 
         if not databases:
             await self._bot.send_message(
@@ -60,9 +62,8 @@ class ChooseDatabaseCommand(AbstractCommand):
                 f"Hooray! Default database has been set to {db.title} 🎉",
             )
 
-            access_token = await self._storage.get_user_access_token(chat_id)
-            db_state = user_notion.databases.query(database_id=db_id)
-            await self._storage.set_user_db_state(db_id, db_state)
+            # the tracker's first poll takes the baseline snapshot
+            await wake_db_poll(self._storage, db_id)
 
             await self.execute_next_if_applicable(message)
             return None
@@ -79,7 +80,7 @@ class ChooseDatabaseCommand(AbstractCommand):
             inline_keyboard.append([button])
 
         markup = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-        current_db_id = await self._storage.get_user_db_id(chat_id)
+        current_db_id = profile.db_id
         if current_db_id:
             current_db_title = '🤷‍♀️'
             for db in databases:
@@ -103,16 +104,13 @@ class ChooseDatabaseCommand(AbstractCommand):
         data = ChooseDatabaseCallback.parse(query.data)
         db_id = data.get("db_id")
 
-        await self._storage.set_user_db_id(query.message.chat.id, db_id)
+        # properties tracked in this database before start over from scratch
+        await self._storage.update_user_profile(chat_id, db_id=db_id, tracked_properties=None)
         await self._bot.send_message(
             chat_id,
             f"Default database has been set to {data.get('db_title')} 🎉",
         )
         await self.remove_temporary_messages(chat_id)
 
-        await self._storage.remove_user_tracked_properties(chat_id)
-        access_token = await self._storage.get_user_access_token(chat_id)
-        user_notion = self._notion(auth=access_token)
-        db_state = user_notion.databases.query(database_id=db_id)
-        await self._storage.set_user_db_state(db_id, db_state)
+        await wake_db_poll(self._storage, db_id)
         await self.execute_next_if_applicable(query.message)
@@ -1,6 +1,5 @@
 from typing import Final, Optional
 
-from aiogram import Bot
 from aiogram import types
 from aiogram.utils import exceptions
 from aiogram.types import (
@@ -13,28 +12,23 @@ from aiogram.utils.callback_data import CallbackData
 
 from app.commands.abstract import AbstractCommand
 from app.storage import Storage
-from app.notion import NotionClient
+from app.notion import AsyncNotionClient
+from app.telegram import TelegramQueue
+from app.tracker.properties import PROPERTY_DIFFERS
 
 ChoosePropertyCallback: Final[CallbackData] = CallbackData("choose_property", "prop_name")
 DonePropertySelectingCallback: Final[CallbackData] = CallbackData("done_property_selecting")
 
 
 class ChoosePropertiesCommand(AbstractCommand):
-    SUPPORTED_PROPERTY_TYPES: Final[list[str]] = [
-        'title',
-        'status',
-        'select',
-        'date',
-        'people',
-        'url',
-    ]
+    SUPPORTED_PROPERTY_TYPES: Final[list[str]] = list(PROPERTY_DIFFERS)
 
     def __init__(
         self,
-        bot: Bot,
+        bot: TelegramQueue,
         next: Optional[AbstractCommand],
         storage: Storage,
-        notion: NotionClient,
+        notion: AsyncNotionClient,
     ):
         super().__init__(bot, next, storage)
         self._notion = notion
@@ -53,11 +47,10 @@ class ChoosePropertiesCommand(AbstractCommand):
         if sent_message_id:
             await self._delete_tracked_properties_message(chat_id, sent_message_id)
 
-        access_token = await self._storage.get_user_access_token(message.chat.id)
-        db_id = await self._storage.get_user_db_id(message.chat.id)
-        user_notion = self._notion(auth=access_token)
+        profile = await self._storage.get_user_profile(message.chat.id)
+        async with self._notion(auth=profile.access_token) as user_notion:
+            database = await user_notion.databases.retrieve(profile.db_id)
 
-        database = user_notion.databases.retrieve(db_id)
         supported_properties = {
             prop_name: prop
             for prop_name, prop in database['properties'].items()
@@ -1,4 +1,3 @@
-from aiogram import Bot
 from aiogram.types import (
     ParseMode,
     Message,
@@ -12,12 +11,13 @@ from aiohttp.web_request import Request
 from app.commands.abstract import AbstractCommand
 from app.notion_oauth import NotionOAuth
 from app.storage import Storage
+from app.telegram import TelegramQueue
 
 
 class ConnectNotionCommand(AbstractCommand):
     def __init__(
         self,
-        bot: Bot,
+        bot: TelegramQueue,
         next: AbstractCommand,
         storage: Storage,
         notion_oauth: NotionOAuth,
@@ -1,9 +1,10 @@
-from aiogram import Bot
 from aiogram.types import Message
 
+from app.telegram import TelegramQueue
+
 
 class StartCommand:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: TelegramQueue):
         self._bot = bot
 
     async def is_applicable(self) -> bool:
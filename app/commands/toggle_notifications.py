@@ -1,12 +1,12 @@
-from aiogram import Bot
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 
 from app.commands.abstract import AbstractCommand
 from app.storage import Storage
+from app.telegram import TelegramQueue
 
 
 class ToggleNotificationsCommand(AbstractCommand):
-    def __init__(self, bot: Bot, storage: Storage):
+    def __init__(self, bot: TelegramQueue, storage: Storage):
         super().__init__(bot, None, storage)
 
     async def is_applicable(self, message: Message) -> bool:
@@ -15,4 +15,8 @@ def load_config() -> dict:
         'redis_cluster_enabled': os.environ["REDIS_CLUSTER_ENABLED"] == 'True',
         'redis_url': os.environ["REDIS_URL"],
         'sentry_dsn': os.environ["SENTRY_DSN"],
+        'notion_webhook_secret': os.environ.get("NOTION_WEBHOOK_SECRET", ""),
+        'tracker_concurrency': int(os.environ.get("TRACKER_CONCURRENCY", 32)),
+        'delivery_concurrency': int(os.environ.get("DELIVERY_CONCURRENCY", 32)),
+        'delivery_consumer': os.environ.get("DELIVERY_CONSUMER", ""),
     }
@@ -0,0 +1,40 @@
+from aiohttp import web
+
+from app import setup
+from app.config import load_config
+
+
+def init_app(config: dict) -> web.Application:
+    app = web.Application()
+    app['config'] = config
+
+    on_startup = [
+        setup.sentry,
+        setup.storage,
+        setup.consumer_name,
+        setup.delivery_pool,
+        setup.start_delivery,
+    ]
+    client_context = [
+        setup.bot,
+        setup.redis,
+        setup.profile_cache,
+        setup.telegram,
+        setup.delivery_wake,
+    ]
+    app.cleanup_ctx.extend(client_context)
+    app.on_startup.extend(on_startup)
+    app.on_shutdown.extend([setup.stop_delivery])
+
+    return app
+
+
+def start() -> None:
+    config = load_config()
+    app = init_app(config)
+
+    web.run_app(app, port=8001, access_log=None)
+
+
+if __name__ == '__main__':
+    start()
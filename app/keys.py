@@ -0,0 +1,81 @@
+"""Redis key schema.
+
+Keys of one user or of one database share a hash tag, the part in braces, so on a cluster
+they land on the same slot and can be used together in a pipeline or a script.
+"""
+from typing import Final
+
+ACTIVE_NOTIFICATIONS: Final[str] = 'active_notifications'
+# the poll schedule and intervals are updated together, so they share a tag too
+DB_POLL_SCHEDULE: Final[str] = '{db_poll}:schedule'
+DB_POLL_INTERVALS: Final[str] = '{db_poll}:intervals'
+# read by the operator to verify the Notion events subscription, see `app.notion_events`
+NOTION_EVENTS_VERIFICATION_TOKEN: Final[str] = 'notion_events:verification_token'
+
+
+def user_tag(chat_id: int) -> str:
+    return f'{{user:{chat_id}}}'
+
+
+def user_profile(chat_id: int) -> str:
+    return f'{user_tag(chat_id)}:profile'
+
+
+def user_private_chat_id(user_id: int) -> str:
+    return f'{user_tag(user_id)}:private_chat_id'
+
+
+def user_temporary_message_ids(chat_id: int) -> str:
+    return f'{user_tag(chat_id)}:temporary_message_ids'
+
+
+def user_tracked_properties_message_id(chat_id: int) -> str:
+    return f'{user_tag(chat_id)}:tracked_properties_message_id'
+
+
+def user_connect_message_id(chat_id: int) -> str:
+    return f'{user_tag(chat_id)}:connect_message_id'
+
+
+def db_tag(db_id: str) -> str:
+    return f'{{db:{db_id}}}'
+
+
+def db_pages(db_id: str) -> str:
+    return f'{db_tag(db_id)}:pages'
+
+
+def db_page_index(db_id: str) -> str:
+    return f'{db_tag(db_id)}:page_index'
+
+
+def db_pages_properties(db_id: str) -> str:
+    return f'{db_tag(db_id)}:pages_properties'
+
+
+def db_state_version(db_id: str) -> str:
+    return f'{db_tag(db_id)}:state_version'
+
+
+def db_events(db_id: str) -> str:
+    return f'{db_tag(db_id)}:events'
+
+
+def db_high_water_mark(db_id: str) -> str:
+    return f'{db_tag(db_id)}:high_water_mark'
+
+
+def db_last_full_sync(db_id: str) -> str:
+    return f'{db_tag(db_id)}:last_full_sync'
+
+
+def db_dirty_pages(db_id: str) -> str:
+    return f'{db_tag(db_id)}:dirty_pages'
+
+
+def db_subscribers(db_id: str) -> str:
+    return f'{db_tag(db_id)}:subscribers'
+
+
+def db_lease(db_id: str) -> str:
+    return f'{db_tag(db_id)}:lease'
@@ -1,15 +1,17 @@
 from typing import Iterable
 
-from aiogram import Bot
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.handler import CancelHandler
 from aiogram.types import Message
 
 from app.commands.abstract import AbstractCommand
+from app.storage import Storage
+from app.telegram import TelegramQueue
+from app.tracker.schedule import wake_db_poll
 
 
 class ForceUserSetupMiddleware(BaseMiddleware):
-    def __init__(self, bot: Bot, setup_commands: Iterable[AbstractCommand]):
+    def __init__(self, bot: TelegramQueue, setup_commands: Iterable[AbstractCommand]):
         super().__init__()
         self._bot = bot
         self._setup_commands = setup_commands
@@ -30,3 +32,16 @@ class ForceUserSetupMiddleware(BaseMiddleware):
                 )
                 await command.execute(message)
                 raise CancelHandler()
+
+
+class WakeTrackerMiddleware(BaseMiddleware):
+    """Resets the poll interval of the chat's database whenever the chat is active."""
+
+    def __init__(self, storage: Storage):
+        super().__init__()
+        self._storage = storage
+
+    async def on_pre_process_message(self, message: Message, data: dict) -> None:
+        db_id = await self._storage.get_user_db_id(message.chat.id)
+        if db_id:
+            await wake_db_poll(self._storage, db_id)
@@ -0,0 +1,120 @@
+"""Move existing data to the hash tagged key schema in `app.keys`.
+
+    python -m app.migrate_keys
+
+Deploys run it before starting the services, see the migrate service in docker-compose.yml.
+It is idempotent: a key already present under its new name wins over the old one, which is
+deleted either way. It also fills the subscriber sets of the databases, the tracker only polls
+databases found in the schedule.
+"""
+import asyncio
+import logging
+import re
+import time
+from typing import Callable, Final, Union
+
+from redis.asyncio import Redis
+from redis.asyncio.cluster import RedisCluster
+
+from app import keys
+from app.config import load_config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# old key pattern and the new key, more specific patterns go first
+RENAMED_KEYS: Final[list[tuple[re.Pattern, Callable[..., str]]]] = [
+    (re.compile(r'^user:(-?\d+):private_chat_id$'), keys.user_private_chat_id),
+    (re.compile(r'^user:(-?\d+):temporary_message_ids$'), keys.user_temporary_message_ids),
+    (re.compile(r'^tracked_properties_message_id_(-?\d+)$'), keys.user_tracked_properties_message_id),
+    (re.compile(r'^sent_connect_message_id_(-?\d+)$'), keys.user_connect_message_id),
+]
+# old keys holding a single profile field
+PROFILE_FIELD_KEYS: Final[list[tuple[re.Pattern, Callable[..., str]]]] = [
+    (re.compile(r'^access_token_(-?\d+)$'), lambda: 'access_token'),
+    (re.compile(r'^db_id_(-?\d+)$'), lambda: 'db_id'),
+    (re.compile(r'^user:(-?\d+):notification_chat_id$'), lambda: 'notification_chat_id'),
+    (re.compile(r'^tracked_properties_(-?\d+)_(.+)$'), lambda db_id: f'tracked_properties:{db_id}'),
+]
+PROFILE_KEY: Final[re.Pattern] = re.compile(r'^\{user:(-?\d+)\}:profile$')
+
+
+async def move_key(redis: Union[Redis, RedisCluster], old_key: str, new_key: str) -> None:
+    # DUMP and RESTORE rather than RENAME, which fails across cluster slots
+    if not await redis.exists(new_key):
+        value = await redis.dump(old_key)
+        if value is None:
+            return
+        ttl = await redis.pttl(old_key)
+        await redis.restore(new_key, max(ttl, 0), value)
+    await redis.delete(old_key)
+
+
+async def move_profile_fields(
+    redis: Union[Redis, RedisCluster],
+    old_key: str,
+    chat_id: str,
+    fields: dict[str, bytes],
+) -> None:
+    profile_key = keys.user_profile(chat_id)
+    for field, value in fields.items():
+        await redis.hsetnx(profile_key, field, value)
+    await redis.delete(old_key)
+
+
+async def migrate_key(redis: Union[Redis, RedisCluster], key: str) -> bool:
+    for pattern, new_key in RENAMED_KEYS:
+        match = pattern.match(key)
+        if match:
+            await move_key(redis, key, new_key(*match.groups()))
+            return True
+
+    for pattern, field in PROFILE_FIELD_KEYS:
+        match = pattern.match(key)
+        if match:
+            chat_id, *field_args = match.groups()
+            value = await redis.get(key)
+            if value is not None:
+                await move_profile_fields(redis, key, chat_id, {field(*field_args): value})
+            return True
+    return False
+
+
+async def index_db_subscribers(redis: Union[Redis, RedisCluster]) -> int:
+    """Fill the subscriber sets of the databases and schedule every tracked one for a poll."""
+    now = time.time()
+    indexed = 0
+    async for key in redis.scan_iter(match='{user:*}:profile'):
+        match = PROFILE_KEY.match(key.decode('utf-8'))
+        db_id = await redis.hget(key, 'db_id')
+        if not match or not db_id:
+            continue
+        db_id = db_id.decode('utf-8')
+        await redis.sadd(keys.db_subscribers(db_id), match.group(1))
+        await redis.zadd(keys.DB_POLL_SCHEDULE, {db_id: now}, nx=True)
+        indexed += 1
+    return indexed
+
+
+async def migrate_keys() -> None:
+    config = load_config()
+    redis_class = RedisCluster if config['redis_cluster_enabled'] else Redis
+    redis = redis_class.from_url(config['redis_url'])
+    migrated = 0
+    try:
+        # collect first, keys written while scanning may otherwise be visited twice
+        old_keys = [key.decode('utf-8') async for key in redis.scan_iter()]
+        for key in old_keys:
+            if await migrate_key(redis, key):
+                migrated += 1
+        indexed = await index_db_subscribers(redis)
+    finally:
+        await redis.close()
+    logger.info(f'Migrated {migrated} keys, indexed {indexed} subscribers')
+
+
+if __name__ == '__main__':
+    asyncio.run(migrate_keys())
@@ -0,0 +1,40 @@
+"""Move database snapshots from the single key format to the per-page layout.
+
+    python -m app.migrate_snapshots
+
+Safe to run while the tracker is up, a database that isn't migrated yet is baselined afresh.
+"""
+import asyncio
+import logging
+
+from redis.asyncio import Redis
+from redis.asyncio.cluster import RedisCluster
+
+from app.config import load_config
+from app.storage import Storage
+from app.tracker.track import migrate_db_state
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+async def migrate_snapshots() -> None:
+    config = load_config()
+    redis_class = RedisCluster if config['redis_cluster_enabled'] else Redis
+    redis = redis_class.from_url(config['redis_url'])
+    storage = Storage(redis)
+    try:
+        for db_id in await storage.get_legacy_db_state_ids():
+            if await migrate_db_state(storage, db_id):
+                logger.info(f'Migrated snapshot of {db_id}')
+            else:
+                logger.info(f'Dropped snapshot of {db_id}, it will be baselined again')
+    finally:
+        await redis.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(migrate_snapshots())
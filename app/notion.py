@@ -1,6 +1,23 @@
+import asyncio
+import hashlib
+import logging
+import random
 from dataclasses import dataclass
+from typing import Any, AsyncIterator, Final, Optional
 
+from notion_client import AsyncClient as AsyncNotionCLI
 from notion_client import Client as NotionCLI
+from notion_client.errors import APIErrorCode, APIResponseError, RequestTimeoutError
+
+from app.rate_limit import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Notion allows an average of three requests per second per integration token
+NOTION_REQUESTS_PER_SECOND: Final[float] = 3
+NOTION_BURST_SIZE: Final[int] = 3
+NOTION_MAX_RETRIES: Final[int] = 5
+NOTION_RETRY_BASE_DELAY: Final[float] = 1
 
 
 @dataclass(frozen=True)
@@ -16,36 +33,157 @@ class Page:
     properties: dict
 
 
+def parse_databases(blocks: dict) -> list[Database]:
+    databases = []
+
+    for block in blocks['results']:
+        if block['object'] == 'database':
+            try:
+                title = block['title'][0]['plain_text']
+            except (KeyError, IndexError):
+                title = "Couldn't get the title 🎅"
+            databases.append(
+                Database(
+                    id=block['id'],
+                    title=title,
+                ),
+            )
+
+    return databases
+
+
+def parse_pages(blocks: dict) -> list[Page]:
+    pages = []
+
+    for block in blocks['results']:
+        pages.append(
+            Page(
+                id=block['id'],
+                title=block['Name']['title'][0]['plain_text'],
+                properties=block['properties'],
+            )
+        )
+    return pages
+
+
 class NotionClient(NotionCLI):
     def list_databases(self) -> list[Database]:
-        blocks = self.search()
-        databases = []
-
-        for block in blocks['results']:
-            if block['object'] == 'database':
-                try:
-                    title = block['title'][0]['plain_text']
-                except (KeyError, IndexError):
-                    title = "Couldn't get the title 🎅"
-                databases.append(
-                    Database(
-                        id=block['id'],
-                        title=title,
-                    ),
-                )
-
-        return databases
+        return parse_databases(self.search())
 
     def list_pages_from(self, db_id: str) -> list[Page]:
-        blocks = self.databases.query(db_id)
-        pages = []
+        return parse_pages(self.databases.query(db_id))
 
-        for block in blocks['results']:
-            pages.append(
-                Page(
-                    id=block['id'],
-                    title=block['Name']['title'][0]['plain_text'],
-                    properties=block['properties'],
-                )
-            )
-        return pages
+
+def get_retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before retrying, `Retry-After` if Notion sent it, exponential otherwise."""
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = NOTION_RETRY_BASE_DELAY * 2 ** attempt
+    # jitter keeps clients throttled at the same moment from retrying in lockstep
+    return delay + random.uniform(0, NOTION_RETRY_BASE_DELAY)
+
+
+class AsyncNotionClient(AsyncNotionCLI):
+    """Non-blocking counterpart of `NotionClient` for use inside coroutines.
+
+    When a `rate_limiter` is given, every request takes a token from the bucket of the
+    client's access token first. Rate limited and timed out requests are retried.
+    """
+
+    def __init__(self, *args: Any, rate_limiter: Optional[RedisTokenBucket] = None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._rate_limiter = rate_limiter
+        self._rate_limit_key = hashlib.sha256((self.options.auth or '').encode()).hexdigest()
+
+    async def request(
+        self,
+        path: str,
+        method: str,
+        query: Optional[dict] = None,
+        body: Optional[dict] = None,
+        auth: Optional[str] = None,
+    ) -> Any:
+        for attempt in range(NOTION_MAX_RETRIES + 1):
+            if self._rate_limiter:
+                await self._rate_limiter.acquire(self._rate_limit_key)
+            try:
+                return await super().request(path, method, query, body, auth)
+            except APIResponseError as e:
+                if e.code != APIErrorCode.RateLimited or attempt == NOTION_MAX_RETRIES:
+                    raise
+                delay = get_retry_delay(attempt, e.headers.get('Retry-After'))
+                if self._rate_limiter:
+                    # every request with this token is throttled, not only this one, so all of
+                    # them in every process back off until the next token is acquired
+                    await self._rate_limiter.throttle(self._rate_limit_key, delay)
+                    logger.warning(f'Notion request to {path} was rate limited, backing off {delay:.1f}s')
+                    continue
+            except RequestTimeoutError:
+                if attempt == NOTION_MAX_RETRIES:
+                    raise
+                delay = get_retry_delay(attempt)
+            logger.warning(f'Notion request to {path} failed, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    async def list_databases(self) -> list[Database]:
+        return parse_databases(await self.search())
+
+    async def list_pages_from(self, db_id: str) -> list[Page]:
+        return parse_pages(await self.databases.query(db_id))
+
+    async def iter_pages(
+        self,
+        db_id: str,
+        page_size: int = 100,
+        prefetch: int = 1,
+        **query: Any,
+    ) -> AsyncIterator[dict]:
+        """Yield every page of the database, following `next_cursor` until `has_more` is false.
+
+        With `prefetch` > 0 up to that many batches are requested ahead in the background
+        while the caller is still consuming the current one.
+        """
+        if prefetch <= 0:
+            async for results in self._query_batches(db_id, page_size, query):
+                for page in results:
+                    yield page
+            return
+
+        batches: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+
+        async def produce() -> None:
+            try:
+                async for results in self._query_batches(db_id, page_size, query):
+                    await batches.put(results)
+            except Exception as exc:
+                await batches.put(exc)
+            else:
+                await batches.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (results := await batches.get()) is not None:
+                if isinstance(results, Exception):
+                    raise results
+                for page in results:
+                    yield page
+        finally:
+            producer.cancel()
+
+    async def _query_batches(
+        self,
+        db_id: str,
+        page_size: int,
+        query: dict,
+    ) -> AsyncIterator[list[dict]]:
+        cursor = None
+        while True:
+            params = {**query, 'page_size': page_size}
+            if cursor:
+                params['start_cursor'] = cursor
+            response = await self.databases.query(database_id=db_id, **params)
+            yield response['results']
+            if not response['has_more']:
+                return
+            cursor = response['next_cursor']
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Final, Optional
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_SIZE: Final[int] = 10_000
+# bounds how long a profile can go stale if an invalidation is lost
+PROFILE_CACHE_TTL: Final[float] = 5 * 60
+PROFILE_INVALIDATION_CHANNEL: Final[str] = 'user_profile_invalidations'
+RESUBSCRIBE_DELAY: Final[float] = 1
+
+
+class ProfileCache:
+    """In-process LRU cache of user profiles whose entries expire after a TTL.
+
+    Writers invalidate entries in every process through `PROFILE_INVALIDATION_CHANNEL`.
+    A read that raced with an invalidation is not cached: `set` takes the `version` seen
+    before the read and drops the value if anything was invalidated since.
+    """
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, Any]] = OrderedDict()
+        self.version = 0
+
+    def get(self, chat_id: int) -> Optional[Any]:
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        expires_at, profile = entry
+        if expires_at < time.monotonic():
+            del self._entries[chat_id]
+            return None
+        self._entries.move_to_end(chat_id)
+        return profile
+
+    def set(self, chat_id: int, profile: Any, version: int) -> None:
+        if version != self.version:
+            return
+        self._entries[chat_id] = (time.monotonic() + self._ttl, profile)
+        self._entries.move_to_end(chat_id)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        self.version += 1
+        self._entries.pop(chat_id, None)
+
+    def clear(self) -> None:
+        self.version += 1
+        self._entries.clear()
+
+
+async def listen_profile_invalidations(redis: Redis, cache: ProfileCache) -> None:
+    """Evict profiles changed by other processes, until cancelled."""
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(PROFILE_INVALIDATION_CHANNEL)
+                # invalidations published while not subscribed are lost
+                cache.clear()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        cache.invalidate(int(message['data']))
+        except Exception as e:
+            # CancelledError is not an Exception, so cancelling still stops the listener
+            logger.error(f'Lost profile invalidations subscription: {repr(e)}', exc_info=True)
+            cache.clear()
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
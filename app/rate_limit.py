@@ -0,0 +1,87 @@
+import asyncio
+
+from redis import asyncio as aioredis
+
+# Refills the bucket from the time elapsed since the last call and takes one token.
+# Returns how long the caller has to wait for the token, 0 if it is available now.
+# Redis server time is used, so every process shares the same clock.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * rate)
+
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+tokens = tokens - 1
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+-- kept until refilled, a bucket in debt must outlive the reservations still waiting
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(wait)
+"""
+
+# Puts the bucket into debt, so no token is available for the next ARGV[3] seconds.
+# A bucket already deeper in debt is left as it is.
+THROTTLE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local delay = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * rate, 1 - delay * rate)
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return redis.status_reply('OK')
+"""
+
+
+class RedisTokenBucket:
+    """Token bucket rate limiter shared by every process connected to the same Redis.
+
+    A token is reserved on every call, so concurrent callers queue up fairly instead of
+    retrying against an empty bucket.
+    """
+
+    def __init__(self, redis: aioredis.Redis, name: str, rate: float, capacity: int):
+        self._redis = redis
+        self._name = name
+        self._rate = rate
+        self._capacity = capacity
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self._throttle_script = redis.register_script(THROTTLE_SCRIPT)
+
+    async def reserve(self, key: str) -> float:
+        """Take a token without waiting for it, returns in how many seconds it may be used."""
+        wait = await self._script(
+            keys=[self._bucket_key(key)],
+            args=[self._rate, self._capacity],
+        )
+        return float(wait)
+
+    async def throttle(self, key: str, delay: float) -> None:
+        """Hold back every caller of the bucket for `delay` seconds, as told by the rate limited API."""
+        await self._throttle_script(
+            keys=[self._bucket_key(key)],
+            args=[self._rate, self._capacity, delay],
+        )
+
+    async def acquire(self, key: str) -> None:
+        wait = await self.reserve(key)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _bucket_key(self, key: str) -> str:
+        return f'rate_limit:{self._name}:{key}'
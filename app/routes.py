@@ -13,3 +13,4 @@ async def setup_routes(app: web.Application) -> None:
     })
 
     cors.add(app.router.add_get('/oauth/callback', app['connect_notion'].handle_oauth))
+    app.router.add_post('/notion/events', app['notion_events'].handle_event)
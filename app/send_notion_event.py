@@ -0,0 +1,53 @@
+"""Local stand-in for Notion's event sender, to exercise the route of a running service.
+
+See `app.check_notion_events` for the offline check.
+
+    python -m app.send_notion_event <db_id> <page_id> [event_type]
+"""
+import asyncio
+import json
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+
+from app.config import load_config
+from app.notion_events import sign_event
+
+EVENTS_URL = 'http://localhost:8080/notion/events'
+
+
+def make_page_event(db_id: str, page_id: str, event_type: str) -> dict:
+    return {
+        'id': str(uuid.uuid4()),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'type': event_type,
+        'entity': {'id': page_id, 'type': 'page'},
+        'data': {'parent': {'id': db_id, 'type': 'database'}},
+    }
+
+
+async def send_event(event: dict, secret: str) -> int:
+    body = json.dumps(event).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Notion-Signature'] = sign_event(secret, body)
+
+    async with aiohttp.ClientSession() as http_client:
+        response = await http_client.post(EVENTS_URL, data=body, headers=headers)
+        await response.release()
+    return response.status
+
+
+def main() -> None:
+    db_id, page_id = sys.argv[1], sys.argv[2]
+    event_type = sys.argv[3] if len(sys.argv) > 3 else 'page.properties_updated'
+    secret = load_config()['notion_webhook_secret']
+
+    status = asyncio.run(send_event(make_page_event(db_id, page_id, event_type), secret))
+    print(f'{event_type} for {page_id} -> {status}')
+
+
+if __name__ == '__main__':
+    main()
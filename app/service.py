@@ -12,7 +12,9 @@ def init_app(config: dict) -> web.Application:
     on_startup = [
         setup.sentry,
         setup.storage,
+        setup.notion_rate_limiter,
         setup.notion_oauth,
+        setup.notion_events,
         setup.dispatcher,
         setup.commands,
         setup_routes,
@@ -21,6 +23,8 @@ def init_app(config: dict) -> web.Application:
     client_context = [
         setup.bot,
         setup.redis,
+        setup.profile_cache,
+        setup.telegram,
     ]
     app.cleanup_ctx.extend(client_context)
     app.on_startup.extend(on_startup)
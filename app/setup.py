@@ -1,6 +1,8 @@
 import re
 import asyncio
 import logging
+import socket
+from functools import partial
 
 import sentry_sdk
 from aiogram import Bot, Dispatcher
@@ -28,10 +30,28 @@ from app.commands.set_notifications import (
     SetupNotificationsCommand,
 )
 from app.commands.toggle_notifications import ToggleNotificationsCommand
-from app.middleware import ForceUserSetupMiddleware
-from app.notion import NotionClient
+from app.middleware import ForceUserSetupMiddleware, WakeTrackerMiddleware
+from app.notion import (
+    NOTION_BURST_SIZE,
+    NOTION_REQUESTS_PER_SECOND,
+    AsyncNotionClient,
+)
+from app.profile_cache import ProfileCache, listen_profile_invalidations
+from app.rate_limit import RedisTokenBucket
 from app.storage import Storage
+from app.telegram import (
+    TELEGRAM_BURST_SIZE,
+    TELEGRAM_CHAT_BURST_SIZE,
+    TELEGRAM_GROUP_MESSAGES_PER_SECOND,
+    TELEGRAM_MESSAGES_PER_SECOND,
+    TELEGRAM_PRIVATE_CHAT_MESSAGES_PER_SECOND,
+    TelegramQueue,
+)
+from app.tracker.delivery import deliver_events, listen_db_events
+from app.tracker.lease import make_worker_id
+from app.tracker.pool import WorkerPool
 from app.notion_oauth import NotionOAuth
+from app.notion_events import NotionEvents
 
 logging.basicConfig(
     level=logging.INFO,
@@ -84,8 +104,112 @@ async def bot(app: Application):
     await app['bot'].close()
 
 
+async def telegram(app: Application):
+    redis = app['redis']
+    app['telegram'] = TelegramQueue(
+        app['bot'],
+        global_limiter=RedisTokenBucket(
+            redis,
+            name='telegram',
+            rate=TELEGRAM_MESSAGES_PER_SECOND,
+            capacity=TELEGRAM_BURST_SIZE,
+        ),
+        private_chat_limiter=RedisTokenBucket(
+            redis,
+            name='telegram_private_chat',
+            rate=TELEGRAM_PRIVATE_CHAT_MESSAGES_PER_SECOND,
+            capacity=TELEGRAM_CHAT_BURST_SIZE,
+        ),
+        group_chat_limiter=RedisTokenBucket(
+            redis,
+            name='telegram_group_chat',
+            rate=TELEGRAM_GROUP_MESSAGES_PER_SECOND,
+            capacity=TELEGRAM_CHAT_BURST_SIZE,
+        ),
+    )
+    app['telegram'].start()
+    yield
+    await app['telegram'].close()
+
+
+async def profile_cache(app: Application):
+    app['profile_cache'] = ProfileCache()
+    # pub/sub messages are broadcast to every node, so a plain connection to one is enough
+    redis = Redis.from_url(app['config']['redis_url'])
+    listener = asyncio.create_task(listen_profile_invalidations(redis, app['profile_cache']))
+    yield
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+    await redis.close()
+
+
 async def storage(app: Application):
-    app['storage'] = Storage(app['redis'])
+    app['storage'] = Storage(app['redis'], profile_cache=app['profile_cache'])
+
+
+async def worker_id(app: Application):
+    app['worker_id'] = make_worker_id()
+    logger.info(f"Tracker worker {app['worker_id']} started")
+
+
+async def tracker_pool(app: Application):
+    app['tracker_pool'] = WorkerPool(app['config']['tracker_concurrency'])
+    app['tracker_runs'] = set()
+
+
+async def stop_tracker_runs(app: Application) -> None:
+    for run in app['tracker_runs']:
+        run.cancel()
+    await asyncio.gather(*app['tracker_runs'], return_exceptions=True)
+
+
+async def delivery_pool(app: Application):
+    app['delivery_pool'] = WorkerPool(app['config']['delivery_concurrency'])
+    app['delivery_retries'] = {}
+
+
+async def consumer_name(app: Application):
+    # kept across restarts of the same container, so they pick up the events left pending
+    app['consumer_name'] = app['config']['delivery_consumer'] or socket.gethostname()
+    logger.info(f"Delivery consumer {app['consumer_name']} started")
+
+
+async def delivery_wake(app: Application):
+    app['delivery_wake'] = asyncio.Event()
+    # pub/sub messages are broadcast to every node, so a plain connection to one is enough
+    redis = Redis.from_url(app['config']['redis_url'])
+    listener = asyncio.create_task(listen_db_events(redis, app['delivery_wake']))
+    yield
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+    await redis.close()
+
+
+async def start_delivery(app: Application) -> None:
+    app['delivery_task'] = asyncio.create_task(deliver_events(app))
+
+
+async def stop_delivery(app: Application) -> None:
+    app['delivery_task'].cancel()
+    try:
+        await app['delivery_task']
+    except asyncio.CancelledError:
+        pass
+
+
+async def notion_rate_limiter(app: Application):
+    app['notion_rate_limiter'] = RedisTokenBucket(
+        app['redis'],
+        name='notion',
+        rate=NOTION_REQUESTS_PER_SECOND,
+        capacity=NOTION_BURST_SIZE,
+    )
 
 
 async def notion_oauth(app: Application):
@@ -97,6 +221,13 @@ async def notion_oauth(app: Application):
     )
 
 
+async def notion_events(app: Application):
+    app['notion_events'] = NotionEvents(
+        storage=app['storage'],
+        secret=app['config']['notion_webhook_secret'],
+    )
+
+
 async def dispatcher(app: Application):
     app['dispatcher'] = Dispatcher(app['bot'])
 
@@ -115,34 +246,35 @@ async def sentry(app: Application):
 
 
 async def commands(app: Application):
+    notion = partial(AsyncNotionClient, rate_limiter=app['notion_rate_limiter'])
     toggle_notifications = ToggleNotificationsCommand(
-        bot=app['bot'],
+        bot=app['telegram'],
         storage=app['storage'],
     )
     setup_notifications = SetupNotificationsCommand(
-        bot=app['bot'],
+        bot=app['telegram'],
         next=toggle_notifications,
         storage=app['storage'],
     )
     choose_properties = ChoosePropertiesCommand(
-        bot=app['bot'],
+        bot=app['telegram'],
         next=setup_notifications,
         storage=app['storage'],
-        notion=NotionClient,
+        notion=notion,
     )
     choose_database = ChooseDatabaseCommand(
-        bot=app['bot'],
+        bot=app['telegram'],
         next=choose_properties,
         storage=app['storage'],
-        notion=NotionClient,
+        notion=notion,
     )
     connect_notion = ConnectNotionCommand(
-        bot=app['bot'],
+        bot=app['telegram'],
         next=choose_database,
         storage=app['storage'],
         notion_oauth=app['notion_oauth'],
     )
-    start = StartCommand(app['bot'])
+    start = StartCommand(app['telegram'])
 
     app['connect_notion'] = connect_notion
     app['dispatcher'].register_message_handler(
@@ -199,4 +331,5 @@ async def commands(app: Application):
         choose_properties,
         setup_notifications,
     )
-    app['dispatcher'].middleware.setup(ForceUserSetupMiddleware(app['bot'], setup_commands))
+    app['dispatcher'].middleware.setup(WakeTrackerMiddleware(app['storage']))
+    app['dispatcher'].middleware.setup(ForceUserSetupMiddleware(app['telegram'], setup_commands))
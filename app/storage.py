@@ -1,143 +1,752 @@
 import json
 import os
-from typing import Optional
+import zlib
+from dataclasses import dataclass
+from typing import Any, Final, Optional
 
+import msgpack
 from dotenv import load_dotenv
 from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+
+from app import keys
+from app.profile_cache import PROFILE_INVALIDATION_CHANNEL, ProfileCache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 load_dotenv()
 TEST_MODE = os.environ.get('TEST_MODE', 'False') == 'True'
 
+# snapshot header: magic, format version, serializer code, compression code
+SNAPSHOT_MAGIC: Final[bytes] = b'NPM'
+SNAPSHOT_FORMAT_VERSION: Final[int] = 1
+SNAPSHOT_HEADER_SIZE: Final[int] = len(SNAPSHOT_MAGIC) + 3
+
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# multi-command writes are scripts rather than MULTI, cluster pipelines can't be transactions
+# ARGV: invalidation channel, chat id, number of removed fields, removed fields, field/value pairs
+# returns the db_id the profile had before
+UPDATE_PROFILE_SCRIPT = """
+local previous_db_id = redis.call('HGET', KEYS[1], 'db_id')
+local removed_count = tonumber(ARGV[3])
+if removed_count > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 4, 3 + removed_count))
+end
+if #ARGV > 3 + removed_count then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 4 + removed_count))
+end
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return previous_db_id
+"""
+# snapshot writes only go through for the sync holding the latest version, they return 0 if
+# another one claimed the snapshot since; change events are appended along with their pages,
+# so they are neither lost nor published for pages that weren't stored
+# KEYS: state version, pages, page index, events
+# ARGV: version, consumer group, events kept, number of updated and of removed pages, then
+# page id, index entry, record triples of updated pages, page id, index entry pairs of removed
+# pages and the events
+WRITE_PAGES_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local updated_end = 5 + tonumber(ARGV[4]) * 3
+local removed_end = updated_end + tonumber(ARGV[5]) * 2
+for i = 6, updated_end, 3 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+    redis.call('ZADD', KEYS[3], 0, ARGV[i + 1])
+end
+for i = updated_end + 1, removed_end, 2 do
+    redis.call('HDEL', KEYS[2], ARGV[i])
+    redis.call('ZREM', KEYS[3], ARGV[i + 1])
+end
+if #ARGV > removed_end and redis.call('EXISTS', KEYS[4]) == 0 then
+    redis.call('XGROUP', 'CREATE', KEYS[4], ARGV[2], '0', 'MKSTREAM')
+end
+for i = removed_end + 1, #ARGV do
+    redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[3], '*', 'event', ARGV[i])
+end
+return 1
+"""
+# KEYS: state version, tracked properties, high water mark, last full sync
+# ARGV: version, tracked properties, high water mark, last full sync, empty ones are left as they are
+COMMIT_DB_STATE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2])
+for i = 3, 4 do
+    if ARGV[i] ~= '' then
+        redis.call('SET', KEYS[i], ARGV[i])
+    end
+end
+return 1
+"""
+# KEYS: poll schedule, poll intervals; ARGV: db id, due at, interval
+SET_POLL_SCHEDULE_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+"""
+# KEYS: poll schedule, poll intervals; ARGV: db id
+REMOVE_POLL_SCHEDULE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+"""
+
+
+class JSONSerializer:
+    code: Final[int] = 0
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackSerializer:
+    code: Final[int] = 1
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data)
+
+
+class NoCompression:
+    code: Final[int] = 0
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCompression:
+    code: Final[int] = 1
+
+    def __init__(self, level: int = 6):
+        self._level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self._level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompression:
+    code: Final[int] = 2
+
+    def __init__(self, level: int = 3):
+        if zstandard is None:
+            raise RuntimeError('zstd compression requires the zstandard package')
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+SERIALIZERS: Final[dict] = {
+    serializer.code: serializer for serializer in (JSONSerializer(), MsgpackSerializer())
+}
+COMPRESSIONS: Final[dict] = {
+    NoCompression.code: NoCompression(),
+    ZlibCompression.code: ZlibCompression(),
+}
+if zstandard is not None:
+    COMPRESSIONS[ZstdCompression.code] = ZstdCompression()
+
+
+class SnapshotCodec:
+    """Encodes snapshots with a versioned header naming the serializer and compression used.
+
+    Values without the header are snapshots written as plain JSON before the header
+    existed, they are decoded as such and rewritten in the current format on next write.
+    """
+
+    def __init__(self, serializer: Any = None, compression: Any = None):
+        self.serializer = serializer or SERIALIZERS[MsgpackSerializer.code]
+        self.compression = compression or COMPRESSIONS.get(
+            ZstdCompression.code, COMPRESSIONS[ZlibCompression.code],
+        )
+
+    def encode(self, obj: Any) -> bytes:
+        header = SNAPSHOT_MAGIC + bytes(
+            [SNAPSHOT_FORMAT_VERSION, self.serializer.code, self.compression.code]
+        )
+        return header + self.compression.compress(self.serializer.dumps(obj))
+
+    def decode(self, data: bytes) -> Any:
+        if not data.startswith(SNAPSHOT_MAGIC):
+            return json.loads(data)
+
+        version, serializer_code, compression_code = data[len(SNAPSHOT_MAGIC):SNAPSHOT_HEADER_SIZE]
+        if version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format version {version}')
+        payload = COMPRESSIONS[compression_code].decompress(data[SNAPSHOT_HEADER_SIZE:])
+        return SERIALIZERS[serializer_code].loads(payload)
+
+
+@dataclass(frozen=True, slots=True)
+class UserProfile:
+    """Everything the tracker and the commands need to know about a user, loaded at once.
+
+    Profiles are shared by everyone reading them from the cache, so they are immutable.
+    """
+    access_token: Optional[str] = None
+    db_id: Optional[str] = None
+    notification_chat_id: Optional[str] = None
+    tracked_properties: Optional[tuple[str, ...]] = None
+
+
+# tracked properties are stored as JSON in a field per database, the rest as they are
+USER_PROFILE_FIELDS: Final[tuple[str, ...]] = (
+    'access_token',
+    'db_id',
+    'notification_chat_id',
+    'tracked_properties',
+)
+
+# profiles fetched per pipelined round trip when loading all subscribers
+PROFILE_BATCH_SIZE: Final[int] = 500
+DB_EVENTS_GROUP: Final[str] = 'delivery'
+# the stream is trimmed to roughly this many events, read or not
+DB_EVENTS_MAX_LEN: Final[int] = 10_000
+# the id of a database is published here once it has new events, delivery waits for it
+DB_EVENTS_CHANNEL: Final[str] = 'db_events'
+
 
 class Storage:
-    def __init__(self, redis: aioredis.Redis):
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        snapshot_codec: Optional[SnapshotCodec] = None,
+        profile_cache: Optional[ProfileCache] = None,
+    ):
         self._redis = redis
+        self._snapshot_codec = snapshot_codec or SnapshotCodec()
+        self._profile_cache = profile_cache
+        self._renew_lease = redis.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = redis.register_script(RELEASE_LEASE_SCRIPT)
+        self._update_profile = redis.register_script(UPDATE_PROFILE_SCRIPT)
+        self._write_pages = redis.register_script(WRITE_PAGES_SCRIPT)
+        self._commit_db_state = redis.register_script(COMMIT_DB_STATE_SCRIPT)
+        self._set_poll_schedule = redis.register_script(SET_POLL_SCHEDULE_SCRIPT)
+        self._remove_poll_schedule = redis.register_script(REMOVE_POLL_SCHEDULE_SCRIPT)
 
-    async def set_user_access_token(self, chat_id: str, access_token: str) -> None:
-        await self._redis.set(f'access_token_{chat_id}', access_token)
+    async def get_user_profile(self, chat_id: int) -> UserProfile:
+        if self._profile_cache is None:
+            return await self._load_user_profile(chat_id)
 
-    async def get_user_access_token(self, chat_id: int) -> Optional[str]:
-        if TEST_MODE:
-            return os.environ['TEST_ACCESS_TOKEN']
+        profile = self._profile_cache.get(int(chat_id))
+        if profile is None:
+            version = self._profile_cache.version
+            profile = await self._load_user_profile(chat_id)
+            self._profile_cache.set(int(chat_id), profile, version)
+        return profile
 
-        token = await self._redis.get(f'access_token_{chat_id}')
-        if not token:
-            return None
-        return token.decode('utf-8')
+    async def get_user_profiles(
+        self,
+        chat_ids: list[int],
+        batch_size: int = PROFILE_BATCH_SIZE,
+    ) -> dict[int, UserProfile]:
+        """Load the profiles of many users, pipelining a batch of them per round trip.
+
+        Cached profiles are served from memory, only the rest is read.
+        """
+        profiles = {}
+        if self._profile_cache is not None:
+            for chat_id in chat_ids:
+                profile = self._profile_cache.get(int(chat_id))
+                if profile is not None:
+                    profiles[chat_id] = profile
+            chat_ids = [chat_id for chat_id in chat_ids if chat_id not in profiles]
+
+        for start in range(0, len(chat_ids), batch_size):
+            batch = chat_ids[start:start + batch_size]
+            version = self._profile_cache.version if self._profile_cache is not None else 0
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for chat_id in batch:
+                    pipe.hgetall(keys.user_profile(chat_id))
+                batch_fields = await pipe.execute()
+            for chat_id, fields in zip(batch, batch_fields):
+                profiles[chat_id] = self._parse_user_profile(fields)
+                if self._profile_cache is not None:
+                    self._profile_cache.set(int(chat_id), profiles[chat_id], version)
+        return profiles
+
+    async def _load_user_profile(self, chat_id: int) -> UserProfile:
+        return self._parse_user_profile(await self._redis.hgetall(keys.user_profile(chat_id)))
+
+    @staticmethod
+    def _parse_user_profile(fields: dict) -> UserProfile:
+        fields = {
+            field.decode('utf-8') if isinstance(field, bytes) else field:
+                value.decode('utf-8') if isinstance(value, bytes) else value
+            for field, value in fields.items()
+        }
+        db_id = os.environ['NOTION_DB_ID'] if TEST_MODE else fields.get('db_id')
+        tracked_properties = fields.get(f'tracked_properties:{db_id}') if db_id else None
+        return UserProfile(
+            access_token=os.environ['TEST_ACCESS_TOKEN'] if TEST_MODE else fields.get('access_token'),
+            db_id=db_id,
+            notification_chat_id=fields.get('notification_chat_id'),
+            tracked_properties=tuple(json.loads(tracked_properties)) if tracked_properties else None,
+        )
+
+    async def update_user_profile(self, chat_id: int, **fields: Any) -> None:
+        """Set the given profile fields in one atomic write, a None value removes the field.
+
+        Tracked properties are kept per database, of the `db_id` given along or the current one.
+        A changed `db_id` moves the user between the subscriber sets of the databases.
+        """
+        unknown_fields = fields.keys() - set(USER_PROFILE_FIELDS)
+        if unknown_fields:
+            raise ValueError(f'Unknown user profile fields: {sorted(unknown_fields)}')
+
+        key = keys.user_profile(chat_id)
+        if 'tracked_properties' in fields:
+            tracked_properties = fields.pop('tracked_properties')
+            db_id = fields.get('db_id')
+            if 'db_id' not in fields:
+                db_id = await self._redis.hget(key, 'db_id')
+                db_id = db_id.decode('utf-8') if db_id else None
+            if db_id:
+                fields[f'tracked_properties:{db_id}'] = (
+                    json.dumps(tracked_properties) if tracked_properties is not None else None
+                )
+
+        removed = [field for field, value in fields.items() if value is None]
+        updated = [item for field, value in fields.items() if value is not None for item in (field, value)]
+        # other processes drop their cached copy, this one doesn't wait for the message
+        previous_db_id = await self._update_profile(
+            keys=[key],
+            args=[PROFILE_INVALIDATION_CHANNEL, chat_id, len(removed), *removed, *updated],
+        )
+        if self._profile_cache is not None:
+            self._profile_cache.invalidate(int(chat_id))
+
+        if 'db_id' in fields:
+            previous_db_id = previous_db_id.decode('utf-8') if previous_db_id else None
+            await self._move_db_subscriber(chat_id, previous_db_id, fields['db_id'])
+
+    async def _move_db_subscriber(
+        self,
+        chat_id: int,
+        previous_db_id: Optional[str],
+        db_id: Optional[str],
+    ) -> None:
+        # kept apart from the profile, the keys of a database live on its own slot, so a switch
+        # that overlaps with another one may add the user after it has already moved on
+        if previous_db_id == db_id:
+            return
+        if previous_db_id:
+            await self._redis.srem(keys.db_subscribers(previous_db_id), chat_id)
+        if db_id:
+            await self._redis.sadd(keys.db_subscribers(db_id), chat_id)
+            current_db_id = await self._redis.hget(keys.user_profile(chat_id), 'db_id')
+            if current_db_id is None or current_db_id.decode('utf-8') != db_id:
+                await self._redis.srem(keys.db_subscribers(db_id), chat_id)
+
+    async def set_user_access_token(self, chat_id: int, access_token: str) -> None:
+        await self.update_user_profile(chat_id, access_token=access_token)
+
+    async def get_user_access_token(self, chat_id: int) -> Optional[str]:
+        return (await self.get_user_profile(chat_id)).access_token
 
     async def set_user_db_id(self, chat_id: int, db_id: str) -> None:
-        await self._redis.set(f'db_id_{chat_id}', db_id)
+        await self.update_user_profile(chat_id, db_id=db_id)
 
     async def get_user_db_id(self, chat_id: int) -> Optional[str]:
-        if TEST_MODE:
-            return os.environ['NOTION_DB_ID']
-
-        db_id = await self._redis.get(f'db_id_{chat_id}')
-        if not db_id:
-            return None
-        return db_id.decode('utf-8')
+        return (await self.get_user_profile(chat_id)).db_id
 
     async def remove_user_db_id(self, chat_id: int) -> None:
-        await self._redis.delete(f'db_id_{chat_id}')
+        await self.update_user_profile(chat_id, db_id=None)
+
+    async def has_db_state(self, db_id: str) -> bool:
+        # the tracked properties are stored with every snapshot, even of an empty database
+        return bool(await self._redis.exists(keys.db_pages_properties(db_id)))
+
+    async def get_db_pages(self, db_id: str, page_ids: list[str]) -> dict[str, dict]:
+        if not page_ids:
+            return {}
+        records = await self._redis.hmget(keys.db_pages(db_id), page_ids)
+        return {
+            page_id: self._snapshot_codec.decode(record)
+            for page_id, record in zip(page_ids, records)
+            if record is not None
+        }
+
+    async def get_db_page_index_range(
+        self,
+        db_id: str,
+        after: Optional[str],
+        count: int,
+    ) -> list[str]:
+        """Index entries following `after` in snapshot order, `created_time|page_id` each."""
+        entries = await self._redis.zrangebylex(
+            keys.db_page_index(db_id),
+            f'({after}' if after else '-',
+            '+',
+            start=0,
+            num=count,
+        )
+        return [entry.decode('utf-8') for entry in entries]
+
+    async def claim_db_state(self, db_id: str) -> int:
+        """Take over writing the snapshot, returns the version writes must be made with."""
+        return await self._redis.incr(keys.db_state_version(db_id))
+
+    async def write_db_pages(
+        self,
+        db_id: str,
+        version: int,
+        updated: list[dict],
+        removed: list[dict],
+        events: list[dict],
+    ) -> bool:
+        """Write and remove pages of the snapshot and append their change events, all at once."""
+        if not updated and not removed and not events:
+            return True
+        # created_time never changes, so re-adding an entry leaves the index as it is
+        is_written = bool(await self._write_pages(
+            keys=[
+                keys.db_state_version(db_id),
+                keys.db_pages(db_id),
+                keys.db_page_index(db_id),
+                keys.db_events(db_id),
+            ],
+            args=[
+                version,
+                DB_EVENTS_GROUP,
+                DB_EVENTS_MAX_LEN,
+                len(updated),
+                len(removed),
+                *[
+                    item
+                    for record in updated
+                    for item in (
+                        record['id'],
+                        f"{record['created_time']}|{record['id']}",
+                        self._snapshot_codec.encode(record),
+                    )
+                ],
+                *[
+                    item
+                    for record in removed
+                    for item in (record['id'], f"{record['created_time']}|{record['id']}")
+                ],
+                *[json.dumps(event, separators=(',', ':')) for event in events],
+            ],
+        ))
+        if is_written and events:
+            await self._redis.publish(DB_EVENTS_CHANNEL, db_id)
+        return is_written
 
-    async def set_user_db_state(self, db_id: str, db_state: dict) -> None:
-        await self._redis.set(f'db_state_{db_id}', json.dumps(db_state['results']))
+    async def commit_db_state(
+        self,
+        db_id: str,
+        version: int,
+        tracked_properties: list[str],
+        high_water_mark: Optional[str],
+        last_full_sync: Optional[float],
+    ) -> bool:
+        return bool(await self._commit_db_state(
+            keys=[
+                keys.db_state_version(db_id),
+                keys.db_pages_properties(db_id),
+                keys.db_high_water_mark(db_id),
+                keys.db_last_full_sync(db_id),
+            ],
+            args=[
+                version,
+                json.dumps(tracked_properties),
+                high_water_mark or '',
+                last_full_sync if last_full_sync is not None else '',
+            ],
+        ))
 
-    async def get_user_db_state(self, db_id: str) -> Optional[dict]:
+    async def get_db_state_properties(self, db_id: str) -> Optional[list[str]]:
+        properties = await self._redis.get(keys.db_pages_properties(db_id))
+        if properties is None:
+            return None
+        return json.loads(properties)
+
+    async def get_legacy_db_state_ids(self) -> list[str]:
+        """Databases with a snapshot stored in a single key, as raw Notion pages."""
+        return sorted([
+            key.decode('utf-8').removeprefix('db_state_')
+            async for key in self._redis.scan_iter(match='db_state_*')
+        ])
+
+    async def get_legacy_db_state(self, db_id: str) -> Optional[list[dict]]:
         db_state = await self._redis.get(f'db_state_{db_id}')
         if not db_state:
             return None
         return json.loads(db_state)
 
-    async def set_user_tracked_properties(self, chat_id: int, tracked_properties: list) -> None:
-        db_id = await self.get_user_db_id(chat_id)
-        if not db_id:
+    async def delete_legacy_db_state(self, db_id: str) -> None:
+        await self._redis.delete(f'db_state_{db_id}')
+
+    async def get_db_high_water_mark(self, db_id: str) -> Optional[str]:
+        last_edited_time = await self._redis.get(keys.db_high_water_mark(db_id))
+        if not last_edited_time:
             return None
-        await self._redis.set(f'tracked_properties_{chat_id}_{db_id}', json.dumps(tracked_properties))
+        return last_edited_time.decode('utf-8')
 
-    async def get_user_tracked_properties(self, chat_id: int) -> Optional[list]:
-        db_id = await self.get_user_db_id(chat_id)
-        if not db_id:
+    async def get_db_last_full_sync(self, db_id: str) -> Optional[float]:
+        timestamp = await self._redis.get(keys.db_last_full_sync(db_id))
+        if not timestamp:
             return None
+        return float(timestamp)
 
-        tracked_properties = await self._redis.get(f'tracked_properties_{chat_id}_{db_id}')
-        if not tracked_properties:
+    async def set_db_poll_schedule(self, db_id: str, due_at: float, interval: float) -> None:
+        await self._set_poll_schedule(
+            keys=[keys.DB_POLL_SCHEDULE, keys.DB_POLL_INTERVALS],
+            args=[db_id, due_at, interval],
+        )
+
+    async def remove_db_poll_schedule(self, db_id: str) -> None:
+        await self._remove_poll_schedule(
+            keys=[keys.DB_POLL_SCHEDULE, keys.DB_POLL_INTERVALS],
+            args=[db_id],
+        )
+
+    async def get_due_db_poll_ids(self, now: float, count: int) -> list[str]:
+        """Databases due to be polled at `now`, the longest overdue first."""
+        db_ids = await self._redis.zrangebyscore(keys.DB_POLL_SCHEDULE, '-inf', now, start=0, num=count)
+        return [db_id.decode('utf-8') for db_id in db_ids]
+
+    async def get_db_poll_due_time(self, db_id: str) -> Optional[float]:
+        return await self._redis.zscore(keys.DB_POLL_SCHEDULE, db_id)
+
+    async def get_db_subscriber_ids(self, db_ids: list[str]) -> dict[str, list[int]]:
+        """Users who chose each of the databases, whether notified or not."""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for db_id in db_ids:
+                pipe.smembers(keys.db_subscribers(db_id))
+            results = await pipe.execute()
+        return {
+            db_id: [int(chat_id.decode('utf-8')) for chat_id in chat_ids]
+            for db_id, chat_ids in zip(db_ids, results)
+        }
+
+    async def get_db_poll_interval(self, db_id: str) -> Optional[float]:
+        interval = await self._redis.hget(keys.DB_POLL_INTERVALS, db_id)
+        if not interval:
             return None
-        return json.loads(tracked_properties)
+        return float(interval)
+
+    async def read_db_events(
+        self,
+        db_ids: list[str],
+        consumer: str,
+        count: int,
+    ) -> dict[str, list[tuple[str, Optional[dict]]]]:
+        """Claim change events, pipelining all databases in one round trip per step.
+
+        Events this consumer read before but never acknowledged, as its delivery failed, are read
+        again first. Only databases with none of those get events not yet read by the group.
+        Returns the entry id and event of each, by database.
+        """
+        events = await self._read_db_events(db_ids, consumer, '0', count)
+        unread_db_ids = [db_id for db_id in db_ids if not events.get(db_id)]
+        events.update(await self._read_db_events(unread_db_ids, consumer, '>', count))
+        return events
+
+    async def _read_db_events(
+        self,
+        db_ids: list[str],
+        consumer: str,
+        entry_id: str,
+        count: int,
+    ) -> dict[str, list[tuple[str, Optional[dict]]]]:
+        if not db_ids:
+            return {}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for db_id in db_ids:
+                pipe.xreadgroup(DB_EVENTS_GROUP, consumer, {keys.db_events(db_id): entry_id}, count=count)
+            # the stream and its group only exist once a database had a change
+            results = await pipe.execute(raise_on_error=False)
+
+        events = {}
+        for db_id, result in zip(db_ids, results):
+            if isinstance(result, ResponseError):
+                if not str(result).startswith('NOGROUP'):
+                    raise result
+                continue
+            for _, entries in result or []:
+                events[db_id] = self._parse_db_events(entries)
+        return events
+
+    async def claim_stale_db_events(
+        self,
+        db_id: str,
+        consumer: str,
+        min_idle_ms: int,
+        count: int,
+    ) -> list[tuple[str, Optional[dict]]]:
+        """Take over events read but never acknowledged by a consumer that has likely died."""
+        try:
+            _, entries, *_ = await self._redis.xautoclaim(
+                keys.db_events(db_id), DB_EVENTS_GROUP, consumer, min_idle_ms, count=count,
+            )
+        except ResponseError as e:
+            if not str(e).startswith('NOGROUP'):
+                raise
+            return []
+        return self._parse_db_events(entries)
+
+    async def remove_idle_db_consumers(self, db_id: str, consumer: str, min_idle_ms: int) -> None:
+        """Forget consumers of a database's events gone for a while, once nothing is pending for them."""
+        try:
+            consumers = await self._redis.xinfo_consumers(keys.db_events(db_id), DB_EVENTS_GROUP)
+        except ResponseError as e:
+            if not str(e).startswith('NOGROUP'):
+                raise
+            return
+        for info in consumers:
+            name = info['name'].decode('utf-8') if isinstance(info['name'], bytes) else info['name']
+            if name != consumer and not info['pending'] and info['idle'] >= min_idle_ms:
+                await self._redis.xgroup_delconsumer(keys.db_events(db_id), DB_EVENTS_GROUP, name)
+
+    async def ack_db_events(self, db_id: str, entry_ids: list[str]) -> None:
+        await self._redis.xack(keys.db_events(db_id), DB_EVENTS_GROUP, *entry_ids)
+
+    @staticmethod
+    def _parse_db_events(entries: list) -> list[tuple[str, Optional[dict]]]:
+        # entries trimmed from the stream while pending come back without fields, they have no
+        # event left but still have to be acknowledged
+        return [
+            (entry_id.decode('utf-8'), json.loads(fields[b'event']) if fields else None)
+            for entry_id, fields in entries
+        ]
+
+    async def add_db_dirty_page_ids(self, db_id: str, page_ids: list[str]) -> None:
+        await self._redis.sadd(keys.db_dirty_pages(db_id), *page_ids)
+
+    async def get_db_dirty_page_ids(self, db_id: str) -> list[str]:
+        page_ids = await self._redis.smembers(keys.db_dirty_pages(db_id))
+        return [page_id.decode('utf-8') for page_id in page_ids]
+
+    async def remove_db_dirty_page_ids(self, db_id: str, page_ids: list[str]) -> None:
+        if page_ids:
+            await self._redis.srem(keys.db_dirty_pages(db_id), *page_ids)
+
+    async def has_db_subscribers(self, db_id: str) -> bool:
+        return bool(await self._redis.scard(keys.db_subscribers(db_id)))
+
+    async def set_notion_events_verification_token(self, token: str) -> None:
+        await self._redis.set(keys.NOTION_EVENTS_VERIFICATION_TOKEN, token)
+
+    async def acquire_db_lease(self, db_id: str, worker_id: str, ttl_ms: int) -> bool:
+        return bool(await self._redis.set(keys.db_lease(db_id), worker_id, nx=True, px=ttl_ms))
+
+    async def renew_db_lease(self, db_id: str, worker_id: str, ttl_ms: int) -> bool:
+        return bool(await self._renew_lease(keys=[keys.db_lease(db_id)], args=[worker_id, ttl_ms]))
+
+    async def release_db_lease(self, db_id: str, worker_id: str) -> None:
+        await self._release_lease(keys=[keys.db_lease(db_id)], args=[worker_id])
+
+    async def set_user_tracked_properties(self, chat_id: int, tracked_properties: list) -> None:
+        await self.update_user_profile(chat_id, tracked_properties=tracked_properties)
+
+    async def get_user_tracked_properties(self, chat_id: int) -> Optional[list]:
+        tracked_properties = (await self.get_user_profile(chat_id)).tracked_properties
+        # a copy the caller is free to change
+        return list(tracked_properties) if tracked_properties is not None else None
 
     async def remove_user_tracked_properties(self, chat_id: int) -> None:
-        db_id = await self.get_user_db_id(chat_id)
-        if not db_id:
-            return None
-        await self._redis.delete(f'tracked_properties_{chat_id}_{db_id}')
+        await self.update_user_profile(chat_id, tracked_properties=None)
 
     async def set_tracked_properties_message_id(self, chat_id: int, message_id: int) -> None:
-        await self._redis.set(f'tracked_properties_message_id_{chat_id}', message_id)
+        await self._redis.set(keys.user_tracked_properties_message_id(chat_id), message_id)
 
     async def get_tracked_properties_message_id(self, chat_id: int) -> Optional[int]:
-        message_id = await self._redis.get(f'tracked_properties_message_id_{chat_id}')
+        message_id = await self._redis.get(keys.user_tracked_properties_message_id(chat_id))
         if not message_id:
             return None
         return int(message_id)
 
     async def delete_tracked_properties_message_id(self, chat_id: int) -> None:
-        await self._redis.delete(f'tracked_properties_message_id_{chat_id}')
+        await self._redis.delete(keys.user_tracked_properties_message_id(chat_id))
 
     async def get_connect_message_id(self, chat_id: int) -> Optional[int]:
-        message_id = await self._redis.get(f'sent_connect_message_id_{chat_id}')
+        message_id = await self._redis.get(keys.user_connect_message_id(chat_id))
         if not message_id:
             return None
         return int(message_id.decode('utf-8'))
 
     async def set_user_notification_chat_id(self, private_chat_id: int, chat_id: int):
-        key = f"user:{private_chat_id}:notification_chat_id"
-        await self._redis.set(key, chat_id)
+        await self.update_user_profile(private_chat_id, notification_chat_id=chat_id)
 
     async def get_user_notification_chat_id(self, chat_id: int) -> Optional[str]:
-        key = f"user:{chat_id}:notification_chat_id"
-        notification_chat_id = await self._redis.get(key)
-        if not notification_chat_id:
-            return None
-        return notification_chat_id.decode('utf-8')
+        return (await self.get_user_profile(chat_id)).notification_chat_id
 
     async def set_user_notification_is_active(self, chat_id: int, is_active: bool) -> None:
-        key = "active_notifications"
+        key = keys.ACTIVE_NOTIFICATIONS
         if is_active:
             await self._redis.sadd(key, chat_id)
         else:
             await self._redis.srem(key, chat_id)
 
     async def get_user_notification_is_active(self, chat_id: int) -> bool:
-        key = "active_notifications"
+        key = keys.ACTIVE_NOTIFICATIONS
         is_active = await self._redis.sismember(key, chat_id)
         return bool(is_active)
 
+    async def filter_active_notification_chat_ids(self, chat_ids: list[int]) -> list[int]:
+        if not chat_ids:
+            return []
+        is_active = await self._redis.smismember(keys.ACTIVE_NOTIFICATIONS, chat_ids)
+        return [chat_id for chat_id, active in zip(chat_ids, is_active) if active]
+
     async def get_all_active_notification_chat_ids(self) -> list[int]:
-        key = "active_notifications"
+        key = keys.ACTIVE_NOTIFICATIONS
         active_chat_ids = await self._redis.smembers(key)
         return [int(chat_id.decode('utf-8')) for chat_id in active_chat_ids]
 
     async def set_user_private_chat_id(self, user_id: int, chat_id: int) -> None:
-        key = f"user:{user_id}:private_chat_id"
+        key = keys.user_private_chat_id(user_id)
         await self._redis.set(key, chat_id)
 
     async def get_user_private_chat_id(self, user_id: int) -> Optional[int]:
-        key = f"user:{user_id}:private_chat_id"
+        key = keys.user_private_chat_id(user_id)
         chat_id = await self._redis.get(key)
         if chat_id:
             return int(chat_id.decode('utf-8'))
         return None
 
     async def add_temporaty_message_id(self, chat_id: int, message_id: int) -> None:
-        key = f"user:{chat_id}:temporary_message_ids"
+        key = keys.user_temporary_message_ids(chat_id)
         await self._redis.sadd(key, message_id)
 
     async def remove_temporary_message_id(self, chat_id: int, message_id: int) -> None:
-        key = f"user:{chat_id}:temporary_message_ids"
+        key = keys.user_temporary_message_ids(chat_id)
         await self._redis.srem(key, message_id)
 
     async def get_temporary_message_ids(self, chat_id: int) -> list:
-        key = f"user:{chat_id}:temporary_message_ids"
+        key = keys.user_temporary_message_ids(chat_id)
         message_ids = await self._redis.smembers(key)
         if not message_ids:
             return []
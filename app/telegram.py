@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Final
+
+from aiogram import Bot
+from aiogram.types import Message
+from aiogram.utils import exceptions
+
+from app.rate_limit import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram's flood limits: about 30 messages per second in total, one per second in a
+# private chat and 20 per minute in a group
+TELEGRAM_MESSAGES_PER_SECOND: Final[float] = 30
+TELEGRAM_BURST_SIZE: Final[int] = 30
+TELEGRAM_PRIVATE_CHAT_MESSAGES_PER_SECOND: Final[float] = 1
+TELEGRAM_GROUP_MESSAGES_PER_SECOND: Final[float] = 20 / 60
+TELEGRAM_CHAT_BURST_SIZE: Final[int] = 3
+TELEGRAM_SENDERS: Final[int] = 8
+
+
+@dataclass
+class TelegramRequest:
+    method: str
+    kwargs: dict
+    future: asyncio.Future
+
+
+def is_group_chat(chat_id: str) -> bool:
+    # groups and channels have negative ids
+    return chat_id.startswith('-')
+
+
+class TelegramQueue:
+    """Sends bot requests through a pool of senders, within Telegram's flood limits.
+
+    Requests to a chat are made one at a time in the order they were submitted, chats take
+    turns. A chat over its limit or told to retry later is set aside until then, so it
+    doesn't hold up a sender. The limits are kept in Redis and shared by every process.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_limiter: RedisTokenBucket,
+        private_chat_limiter: RedisTokenBucket,
+        group_chat_limiter: RedisTokenBucket,
+        senders: int = TELEGRAM_SENDERS,
+    ):
+        self._bot = bot
+        self._global_limiter = global_limiter
+        self._private_chat_limiter = private_chat_limiter
+        self._group_chat_limiter = group_chat_limiter
+        self._sender_count = senders
+        self._senders: list[asyncio.Task] = []
+        # a chat is in here while it has requests, and in the ready queue only when it is due
+        self._chats: dict[str, deque[TelegramRequest]] = {}
+        self._ready: asyncio.Queue[str] = asyncio.Queue()
+        # chats that already hold a token for their next request
+        self._reserved: set[str] = set()
+
+    def start(self) -> None:
+        self._senders = [asyncio.create_task(self._send_forever()) for _ in range(self._sender_count)]
+
+    async def close(self) -> None:
+        for sender in self._senders:
+            sender.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        for requests in self._chats.values():
+            for request in requests:
+                request.future.cancel()
+        self._chats.clear()
+
+    @property
+    def me(self) -> Any:
+        return self._bot.me
+
+    def submit(self, chat_id: Any, method: str, /, **kwargs: Any) -> asyncio.Future:
+        """Queue a call of a bot method about the chat, the future resolves to its result."""
+        chat_id = str(chat_id)
+        request = TelegramRequest(method, kwargs, asyncio.get_running_loop().create_future())
+        if chat_id not in self._chats:
+            self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        self._chats[chat_id].append(request)
+        return request.future
+
+    async def send_message(self, chat_id: Any, text: str, **kwargs: Any) -> Message:
+        return await self.submit(chat_id, 'send_message', chat_id=chat_id, text=text, **kwargs)
+
+    async def edit_message_text(self, text: str, chat_id: Any, message_id: int, **kwargs: Any) -> Any:
+        return await self.submit(
+            chat_id, 'edit_message_text', text=text, chat_id=chat_id, message_id=message_id, **kwargs,
+        )
+
+    async def delete_message(self, chat_id: Any, message_id: int) -> bool:
+        return await self.submit(chat_id, 'delete_message', chat_id=chat_id, message_id=message_id)
+
+    async def _send_forever(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            delay = await self._send_next(chat_id)
+            self._schedule(chat_id, delay)
+
+    async def _send_next(self, chat_id: str) -> float:
+        """Make the next request of the chat, returns in how long the chat is due again."""
+        request = self._chats[chat_id][0]
+        if request.future.cancelled():
+            self._chats[chat_id].popleft()
+            return 0
+        try:
+            if chat_id not in self._reserved:
+                limiter = self._group_chat_limiter if is_group_chat(chat_id) else self._private_chat_limiter
+                wait = await limiter.reserve(chat_id)
+                if wait > 0:
+                    self._reserved.add(chat_id)
+                    return wait
+            self._reserved.discard(chat_id)
+            await self._global_limiter.acquire('global')
+            result = await getattr(self._bot, request.method)(**request.kwargs)
+        except exceptions.RetryAfter as e:
+            logger.warning(f'Flood limit hit in {chat_id}, retrying in {e.timeout}s')
+            self._reserved.add(chat_id)
+            return e.timeout
+        except Exception as e:
+            self._chats[chat_id].popleft()
+            if not request.future.done():
+                request.future.set_exception(e)
+            return 0
+
+        self._chats[chat_id].popleft()
+        if not request.future.done():
+            request.future.set_result(result)
+        return 0
+
+    def _schedule(self, chat_id: str, delay: float) -> None:
+        if not self._chats[chat_id]:
+            del self._chats[chat_id]
+            self._reserved.discard(chat_id)
+        elif delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
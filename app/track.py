@@ -13,15 +13,20 @@ def init_app(config: dict) -> web.Application:
     on_startup = [
         setup.sentry,
         setup.storage,
+        setup.notion_rate_limiter,
+        setup.worker_id,
+        setup.tracker_pool,
         setup.start_rocketry,
     ]
     client_context = [
         setup.bot,
         setup.redis,
+        setup.profile_cache,
+        setup.telegram,
     ]
     app.cleanup_ctx.extend(client_context)
     app.on_startup.extend(on_startup)
-    app.on_shutdown.extend([setup.shutdown_rocketry])
+    app.on_shutdown.extend([setup.shutdown_rocketry, setup.stop_tracker_runs])
     setup_jobs(app, scheduler)
 
     return app
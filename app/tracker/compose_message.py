@@ -1,63 +1,19 @@
-from datetime import datetime
-from typing import Any, Optional
+import re
+from typing import Any, Final
 from html import escape
 
 from aiogram.types import ParseMode
 
-from app.tracker.entities import Page, PageChange, Property
-
-
-def to_user_friendly_dt(date_string: Optional[str]) -> str:
-    if not date_string:
-        return ''
-
-    if len(date_string) > 10:
-        dt = datetime.fromisoformat(date_string)
-        date_string = dt.strftime("%Y-%m-%d %l:%M%p").replace(":00", "").strip()
-    return date_string
-
-
-def compose_property_diff(old: Property, new: Property) -> tuple[str, str, str]:
-    if old.type == 'title':
-        emoji = '🔎'
-        old_value = old.content[0]['plain_text']
-        new_value = new.content[0]['plain_text']
-    elif old.type == 'status':
-        emoji = '🚦'
-        old_value = old.content['name']
-        new_value = new.content['name']
-    elif old.type == 'select':
-        emoji = '🚦'
-        old_value = old.content['name']
-        new_value = new.content['name']
-    elif old.type == 'date':
-        emoji = '📅'
-        old_start = to_user_friendly_dt(old.content['start'] if old.content else None)
-        new_start = to_user_friendly_dt(new.content['start'] if new.content else None)
-        old_end = to_user_friendly_dt(old.content['end'] if old.content else None)
-        new_end = to_user_friendly_dt(new.content['end'] if new.content else None)
-        # old value
-        if old_start and not old_end:
-            old_value = old_start
-        else:
-            old_value = f'{old_start} to {old_end}'
-        # new value
-        if new_start and not new_end:
-            new_value = new_start
-        else:
-            new_value = f'{new_start} to {new_end}'
-    elif old.type == 'people':
-        emoji = '🦹‍♀️'
-        old_value = ', '.join([person['name'] for person in old.content])
-        new_value = ', '.join([person['name'] for person in new.content])
-    elif old.type == 'url':
-        emoji = '🔗'
-        old_value = old.content
-        new_value = new.content
-    else:
-        emoji = '🤷‍♀️'
-        old_value, new_value = 'unknown', 'unknown'
-    return emoji, old_value, new_value
+from app.tracker.entities import Page, PageChange
+from app.tracker.properties import format_property_change, shorten
+
+# Telegram counts the length of the text without the markup, the markup is counted too here
+MAX_MESSAGE_LENGTH: Final[int] = 4096
+# a bulk edit is summed up after this many messages instead of flooding the chat
+MAX_BATCH_MESSAGES: Final[int] = 5
+BLOCK_SEPARATOR: Final[str] = '\n\n'
+# left free in every message for the overflow summary
+SUMMARY_RESERVE: Final[int] = 64
 
 
 def escape_html(any: Any) -> str:
@@ -69,24 +25,70 @@ def compose_page_change(page_change: PageChange) -> tuple[str, str]:
     for field_change in page_change.field_changes:
         field_message = (
             f"{field_change.emoji} <b>{escape_html(field_change.name)}</b>: "
-            f"{escape_html(field_change.old_value)} → "
-            f"{escape_html(field_change.new_value)}\n\n"
+            f"{escape_html(format_property_change(field_change.type, field_change.old_value, field_change.new_value))}\n\n"
         )
         messages.append(field_message)
 
     message = (
         f"📬 Changes in <a href='{escape_html(page_change.url)}'>"
-        f"{escape_html(page_change.name)}</a>:\n\n"
+        f"{escape_html(shorten(page_change.name))}</a>:\n\n"
         f"{''.join(messages)}"
     )
     return message, ParseMode.HTML
 
 
 def compose_page_added(page: Page) -> tuple[str, str]:
-    text = f"🌱 New page added: <a href='{escape_html(page.url)}'>{escape_html(page.name)}</a>"
+    text = f"🌱 New page added: <a href='{escape_html(page.url)}'>{escape_html(shorten(page.name))}</a>"
     return text, ParseMode.HTML
 
 
 def compose_page_removed(page: Page) -> tuple[str, str]:
-    text = f"🗑️ Page removed: <a href='{escape_html(page.url)}'>{escape_html(page.name)}</a>"
+    text = f"🗑️ Page removed: <a href='{escape_html(page.url)}'>{escape_html(shorten(page.name))}</a>"
     return text, ParseMode.HTML
+
+
+def truncate_block(block: str, max_length: int) -> str:
+    """Cut a block down to the lines that fit, lines are cut whole so no tag is left open."""
+    if len(block) <= max_length:
+        return block
+    lines = block.split(BLOCK_SEPARATOR)
+    if len(lines[0]) > max_length - len(BLOCK_SEPARATOR) - 1:
+        # not even the first line fits, so its markup goes and the text itself is cut
+        text = re.sub(r'<[^>]*>', '', lines[0])[:max_length - 1]
+        # an entity cut in half would not parse either
+        return re.sub(r'&[^;]*$', '', text) + '…'
+    kept, length = [lines[0]], len(lines[0])
+    for line in lines[1:]:
+        length += len(BLOCK_SEPARATOR) + len(line)
+        if length > max_length - len(BLOCK_SEPARATOR) - 1:
+            break
+        kept.append(line)
+    return BLOCK_SEPARATOR.join(kept + ['…'])
+
+
+def compose_batch(
+    blocks: list[str],
+    max_length: int = MAX_MESSAGE_LENGTH,
+    max_messages: int = MAX_BATCH_MESSAGES,
+) -> list[tuple[str, int]]:
+    """Pack the blocks composed for one chat into as few messages as possible, in order.
+
+    Blocks are never split across messages. What doesn't fit into `max_messages` messages is
+    summed up at the end of the last one. Returns each message with the number of blocks in it.
+    """
+    max_length -= SUMMARY_RESERVE
+    messages: list[list[str]] = []
+    length = 0
+    for index, block in enumerate(blocks):
+        block = truncate_block(block.strip(), max_length)
+        if messages and length + len(BLOCK_SEPARATOR) + len(block) <= max_length:
+            messages[-1].append(block)
+            length += len(BLOCK_SEPARATOR) + len(block)
+            continue
+        if len(messages) == max_messages:
+            remaining = len(blocks) - index
+            messages[-1].append(f"…and {remaining} more {'page' if remaining == 1 else 'pages'}")
+            break
+        messages.append([block])
+        length = len(block)
+    return [(BLOCK_SEPARATOR.join(message), len(message)) for message in messages]
@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Awaitable, Callable, Final, Optional
+
+from aiogram.types import ParseMode
+from aiogram.utils import exceptions
+from aiohttp.web import Application
+from redis.asyncio import Redis
+
+from app.storage import DB_EVENTS_CHANNEL
+from app.telegram import TelegramQueue
+from app.tracker.compose_message import (
+    compose_batch,
+    compose_page_added,
+    compose_page_change,
+    compose_page_removed,
+)
+from app.tracker.entities import PageChange, Subscriber
+from app.tracker.events import PAGE_ADDED, PAGE_REMOVED, decode_event
+from app.tracker.track import load_subscribers_by_db
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BATCH_SIZE: Final[int] = 100
+# new events wake delivery up, this only bounds how long a lost wake-up can delay them
+DELIVERY_IDLE_TIMEOUT: Final[float] = 30
+DELIVERY_ERROR_DELAY: Final[float] = 1
+RESUBSCRIBE_DELAY: Final[float] = 1
+# events of a consumer that stopped acknowledging for this long are taken over, a batch sent
+# to a group at its 20 messages a minute must be well done by then
+STALE_EVENT_IDLE_MS: Final[int] = 15 * 60 * 1000
+STALE_EVENT_CLAIM_INTERVAL: Final[float] = 60
+# a database nobody was subscribed to for a while doesn't get its old changes sent later
+EVENT_MAX_AGE_MS: Final[int] = 60 * 60 * 1000
+# other Telegram errors won't go away by sending again, the chat misses the events instead
+RETRYABLE_SEND_ERRORS: Final[tuple[type[Exception], ...]] = (exceptions.RetryAfter, exceptions.NetworkError)
+DELIVERY_MAX_ATTEMPTS: Final[int] = 8
+DELIVERY_RETRY_BASE_DELAY: Final[float] = 2
+DELIVERY_MAX_RETRY_DELAY: Final[float] = 5 * 60
+
+
+@dataclass(slots=True)
+class DeliveryRetry:
+    """A batch of events whose delivery failed, kept pending to be sent again after a delay."""
+    entry_ids: list[str]
+    attempts: int = 0
+    retry_at: float = 0
+    # chats that got the batch already aren't sent it again
+    notified_chat_ids: set[int] = field(default_factory=set)
+
+
+def filter_page_change(page_change: PageChange, tracked_properties: list[str]) -> Optional[PageChange]:
+    field_changes = [
+        field_change
+        for field_change in page_change.field_changes
+        if field_change.name in tracked_properties
+    ]
+    if not field_changes:
+        return None
+    return PageChange(page_change.name, page_change.url, field_changes)
+
+
+def compose_event(subscriber: Subscriber, event: str, item: Any) -> Optional[str]:
+    if event == PAGE_ADDED:
+        message, _ = compose_page_added(item)
+    elif event == PAGE_REMOVED:
+        message, _ = compose_page_removed(item)
+    else:
+        page_change = filter_page_change(item, subscriber.tracked_properties)
+        if page_change is None:
+            return None
+        message, _ = compose_page_change(page_change)
+    return message
+
+
+def submit_notifications(
+    telegram: TelegramQueue,
+    subscribers: list[Subscriber],
+    events: list[tuple[str, Any]],
+) -> list[tuple[Subscriber, asyncio.Future]]:
+    """Queue the messages about the events, packed together into as few as possible per chat."""
+    sends = []
+    for subscriber in subscribers:
+        blocks = [
+            block
+            for event, item in events
+            if (block := compose_event(subscriber, event, item)) is not None
+        ]
+        for message, block_count in compose_batch(blocks):
+            future = telegram.submit(
+                subscriber.notification_chat_id,
+                'send_message',
+                chat_id=subscriber.notification_chat_id,
+                text=message,
+                parse_mode=ParseMode.HTML,
+                # a preview is only shown for the first link, which is misleading with several pages
+                disable_web_page_preview=block_count > 1,
+            )
+            sends.append((subscriber, future))
+    return sends
+
+
+async def wait_notified(
+    sends: list[tuple[Subscriber, asyncio.Future]],
+) -> tuple[set[int], Optional[BaseException]]:
+    """Wait for the messages to go out, returns the chats to retry and the first error to retry for."""
+    results = await asyncio.gather(*(future for _, future in sends), return_exceptions=True)
+    failed_chat_ids, error = set(), None
+    for (subscriber, _), result in zip(sends, results):
+        if not isinstance(result, BaseException):
+            continue
+        if isinstance(result, exceptions.TelegramAPIError) and not isinstance(result, RETRYABLE_SEND_ERRORS):
+            # retrying won't help, the event is still delivered to everyone else
+            logger.warning(f'Could not notify {subscriber.chat_id}: {repr(result)}')
+            continue
+        failed_chat_ids.add(subscriber.chat_id)
+        error = error or result
+    return failed_chat_ids, error
+
+
+def parse_entry_id(entry_id: str) -> tuple[int, int]:
+    # stream entry ids are the time they were added at, in milliseconds, and a sequence number
+    milliseconds, sequence = entry_id.split('-', 1)
+    return int(milliseconds), int(sequence)
+
+
+def is_delivery_due(app: Application, db_id: str) -> bool:
+    retry = app['delivery_retries'].get(db_id)
+    return retry is None or retry.retry_at <= time.monotonic()
+
+
+def is_event_expired(entry_id: str) -> bool:
+    return parse_entry_id(entry_id)[0] < time.time() * 1000 - EVENT_MAX_AGE_MS
+
+
+def merge_entries(*entry_lists: list[tuple[str, Optional[dict]]]) -> list[tuple[str, Optional[dict]]]:
+    """Merge stream entries read in several ways, each once and in the order they were added."""
+    entries = {entry_id: event for entry_list in entry_lists for entry_id, event in entry_list}
+    return sorted(entries.items(), key=lambda entry: parse_entry_id(entry[0]))
+
+
+async def deliver_db_events(
+    app: Application,
+    db_id: str,
+    subscribers: list[Subscriber],
+    entries: list[tuple[str, Optional[dict]]],
+) -> None:
+    """Send a batch of events as a few messages per chat, acknowledged once they all went out.
+
+    A batch that failed to send for a reason that may pass stays pending, its messages not sent
+    yet are withdrawn. It is sent again after a growing delay to the chats that didn't get it,
+    until `DELIVERY_MAX_ATTEMPTS` is reached and it is dropped. Delivery is at least once: a
+    subscriber may get some of the events again.
+    """
+    entry_ids = [entry_id for entry_id, _ in entries]
+    retry = app['delivery_retries'].get(db_id)
+    if retry is None or retry.entry_ids != entry_ids:
+        retry = DeliveryRetry(entry_ids)
+    subscribers = [
+        subscriber for subscriber in subscribers if subscriber.chat_id not in retry.notified_chat_ids
+    ]
+    events = [
+        decode_event(event)
+        for entry_id, event in entries
+        if event is not None and not is_event_expired(entry_id)
+    ]
+    sends = submit_notifications(app['telegram'], subscribers, events)
+    try:
+        failed_chat_ids, error = await wait_notified(sends)
+    finally:
+        for _, future in sends:
+            future.cancel()
+
+    if error is not None:
+        retry.notified_chat_ids.update(
+            subscriber.chat_id for subscriber in subscribers if subscriber.chat_id not in failed_chat_ids
+        )
+        retry.attempts += 1
+        if retry.attempts < DELIVERY_MAX_ATTEMPTS:
+            delay = min(DELIVERY_RETRY_BASE_DELAY * 2 ** (retry.attempts - 1), DELIVERY_MAX_RETRY_DELAY)
+            retry.retry_at = time.monotonic() + delay
+            app['delivery_retries'][db_id] = retry
+            raise error
+        logger.error(f'Dropping {len(entries)} events of {db_id} after {retry.attempts} attempts: {repr(error)}')
+    app['delivery_retries'].pop(db_id, None)
+    await app['storage'].ack_db_events(db_id, entry_ids)
+
+
+async def run_delivery_jobs(app: Application, jobs: dict[str, Callable[[], Awaitable[Any]]]) -> None:
+    report = await app['delivery_pool'].run(jobs)
+    logger.info(
+        f'Delivered events of {report.finished} databases, {report.failed} failed, '
+        f'{report.skipped} skipped'
+    )
+
+
+async def deliver_events_for_all(app: Application, claim_stale: bool) -> Optional[asyncio.Task]:
+    """Start delivering the next batch of events of every database, returns the running delivery.
+
+    Databases whose previous batch is still being sent, slowed down by the flood limits of
+    their chats, are left out until it is done.
+    """
+    storage = app['storage']
+    active_notification_chat_ids = await storage.get_all_active_notification_chat_ids()
+    subscribers_by_db = await load_subscribers_by_db(storage, active_notification_chat_ids)
+    db_ids = [
+        db_id
+        for db_id in subscribers_by_db
+        if not app['delivery_pool'].is_running(db_id) and is_delivery_due(app, db_id)
+    ]
+    entries_by_db = await storage.read_db_events(db_ids, app['consumer_name'], DELIVERY_BATCH_SIZE)
+    if claim_stale:
+        for db_id in db_ids:
+            stale_entries = await storage.claim_stale_db_events(
+                db_id, app['consumer_name'], STALE_EVENT_IDLE_MS, DELIVERY_BATCH_SIZE,
+            )
+            # whatever those consumers held was just taken over, so they can go
+            await storage.remove_idle_db_consumers(db_id, app['consumer_name'], STALE_EVENT_IDLE_MS)
+            if stale_entries:
+                entries_by_db[db_id] = merge_entries(stale_entries, entries_by_db.get(db_id, []))
+
+    jobs = {
+        db_id: partial(deliver_db_events, app, db_id, subscribers_by_db[db_id], entries)
+        for db_id, entries in entries_by_db.items()
+        if entries
+    }
+    if not jobs:
+        return None
+    return asyncio.create_task(run_delivery_jobs(app, jobs))
+
+
+async def listen_db_events(redis: Redis, wake: asyncio.Event) -> None:
+    """Wake delivery up whenever a database got new events, until cancelled."""
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(DB_EVENTS_CHANNEL)
+                # events appended while not subscribed went unnoticed
+                wake.set()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        wake.set()
+        except Exception as e:
+            logger.error(f'Lost database events subscription: {repr(e)}', exc_info=True)
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+
+def get_idle_timeout(app: Application, next_stale_claim: float) -> float:
+    """How long delivery may wait for a wake-up, a batch due for a retry or a stale claim comes first."""
+    retry_times = [retry.retry_at for retry in app['delivery_retries'].values()]
+    wake_at = min([next_stale_claim, *retry_times])
+    return max(0.0, min(DELIVERY_IDLE_TIMEOUT, wake_at - time.monotonic()))
+
+
+async def deliver_events(app: Application) -> None:
+    """Keep delivering events until cancelled, waiting for new ones while there are none."""
+    wake = app['delivery_wake']
+    deliveries: set[asyncio.Task] = set()
+    last_stale_claim = 0.0
+    try:
+        while True:
+            # cleared before reading, so events appended meanwhile wake the next pass
+            wake.clear()
+            claim_stale = time.monotonic() - last_stale_claim >= STALE_EVENT_CLAIM_INTERVAL
+            if claim_stale:
+                last_stale_claim = time.monotonic()
+            try:
+                delivery = await deliver_events_for_all(app, claim_stale)
+            except Exception as e:
+                logger.error(f'Error while delivering events: {repr(e)}', exc_info=e)
+                await asyncio.sleep(DELIVERY_ERROR_DELAY)
+                continue
+
+            if delivery is not None:
+                deliveries.add(delivery)
+                delivery.add_done_callback(deliveries.discard)
+                # the databases it held back may have more events by the time it is done
+                delivery.add_done_callback(lambda _: wake.set())
+                continue
+            timeout = get_idle_timeout(app, last_stale_claim + STALE_EVENT_CLAIM_INTERVAL)
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for delivery in deliveries:
+            delivery.cancel()
@@ -2,8 +2,11 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Any, Optional, Union
 
+UNNAMED_PAGE = 'Unnamed page 🤷‍♀️'
+_NOT_LOADED = object()
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class Property:
     id: str
     name: str
@@ -20,58 +23,91 @@ class Property:
         )
 
 
-@dataclass(frozen=True)
 class Page:
-    id: str
-    created_time: str
-    last_edited_time: str
-    created_by: dict
-    last_edited_by: dict
-    cover: Optional[dict]
-    icon: Optional[dict]
-    parent: Optional[dict]
-    archived: bool
-    url: str
-    properties: list[Property]
+    """A database page whose properties are parsed only when they are looked up.
+
+    Wide databases have dozens of columns while only a few are tracked, the rest stay raw JSON.
+    """
+
+    __slots__ = ('id', 'last_edited_time', 'url', '_raw_properties', '_properties', '_ids', '_title')
+
+    def __init__(
+        self,
+        id: str,
+        last_edited_time: str,
+        url: str,
+        raw_properties: dict,
+        title: Any = _NOT_LOADED,
+    ):
+        self.id = id
+        self.last_edited_time = last_edited_time
+        self.url = url
+        self._raw_properties = raw_properties
+        self._properties: dict[str, Property] = {}
+        self._ids: Optional[dict[str, str]] = None
+        self._title = title
+
+    def __repr__(self) -> str:
+        return f'Page(id={self.id!r}, name={self.name!r})'
 
     @property
     def name(self) -> str:
-        for property in self.properties:
-            if property.type == 'title' and property.content:
-                return property.content[0]['plain_text']
-        return 'Unnamed page 🤷‍♀️'
+        if self._title is _NOT_LOADED:
+            self._title = None
+            for content in self._raw_properties.values():
+                if content['type'] == 'title' and content['title']:
+                    self._title = content['title'][0]['plain_text']
+                    break
+        return self._title or UNNAMED_PAGE
+
+    def get_property(self, name: str) -> Optional[Property]:
+        property = self._properties.get(name)
+        if property is None and name in self._raw_properties:
+            property = Property.from_json(name, self._raw_properties[name])
+            self._properties[name] = property
+        return property
+
+    def get_property_by_id(self, property_id: str) -> Optional[Property]:
+        if self._ids is None:
+            self._ids = {
+                content['id']: name for name, content in self._raw_properties.items()
+            }
+        name = self._ids.get(property_id)
+        return self.get_property(name) if name is not None else None
 
     @classmethod
     def from_json(cls, json: dict) -> 'Page':
-        properties = []
-        for name, content in json['properties'].items():
-            properties.append(Property.from_json(name, content))
-
+        """Wrap a snapshot record or a raw Notion page without parsing its properties."""
         return cls(
             id=json['id'],
-            created_time=json['created_time'],
             last_edited_time=json['last_edited_time'],
-            created_by=json['created_by'],
-            last_edited_by=json['last_edited_by'],
-            cover=json['cover'],
-            icon=json['icon'],
-            parent=json['parent'],
-            archived=json['archived'],
             url=json['url'],
-            properties=properties,
+            raw_properties=json['properties'],
+            title=json.get('title', _NOT_LOADED),
         )
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PropertyChange:
     name: str
-    old_value: str
-    new_value: str
+    old_value: Any
+    new_value: Any
     emoji: str
+    # picks how the values are rendered, see `app.tracker.properties.PROPERTY_DIFFERS`
+    type: Optional[str] = None
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PageChange:
     name: str
     url: str
     field_changes: list[PropertyChange]
+
+
+@dataclass(frozen=True, slots=True)
+class Subscriber:
+    chat_id: int
+    notification_chat_id: str
+    access_token: str
+    db_id: str
+    tracked_properties: list[str]
@@ -0,0 +1,44 @@
+from typing import Any, Final
+
+from app.tracker.entities import Page, PageChange, PropertyChange
+
+PAGE_ADDED: Final[str] = 'added'
+PAGE_REMOVED: Final[str] = 'removed'
+PAGE_CHANGED: Final[str] = 'changed'
+
+
+def encode_event(event: str, item: Any) -> dict:
+    """Turn a change found by the tracker into a stream event, keeping only what is rendered."""
+    if event == PAGE_CHANGED:
+        return {
+            'type': event,
+            'name': item.name,
+            'url': item.url,
+            'changes': [
+                [change.name, change.old_value, change.new_value, change.emoji, change.type]
+                for change in item.field_changes
+            ],
+        }
+    return {
+        'type': event,
+        'id': item.id,
+        'name': item.name,
+        'url': item.url,
+        'last_edited_time': item.last_edited_time,
+    }
+
+
+def decode_event(event: dict) -> tuple[str, Any]:
+    if event['type'] == PAGE_CHANGED:
+        return event['type'], PageChange(
+            event['name'],
+            event['url'],
+            [PropertyChange(*change) for change in event['changes']],
+        )
+    return event['type'], Page(
+        id=event['id'],
+        last_edited_time=event['last_edited_time'],
+        url=event['url'],
+        raw_properties={},
+        title=event['name'],
+    )
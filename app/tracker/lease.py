@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Final
+
+from app.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# a dead worker's databases are taken over once its leases expire
+DB_LEASE_TTL: Final[int] = 30_000
+DB_LEASE_HEARTBEAT_INTERVAL: Final[float] = 10
+
+
+def make_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+async def _keep_db_lease(storage: Storage, db_id: str, worker_id: str) -> None:
+    while True:
+        await asyncio.sleep(DB_LEASE_HEARTBEAT_INTERVAL)
+        if not await storage.renew_db_lease(db_id, worker_id, DB_LEASE_TTL):
+            logger.warning(f'Worker {worker_id} lost the lease on {db_id}')
+            return
+
+
+@asynccontextmanager
+async def db_lease(storage: Storage, db_id: str, worker_id: str) -> AsyncIterator[bool]:
+    """Hold the database exclusively for this worker, yields whether the lease was acquired."""
+    if not await storage.acquire_db_lease(db_id, worker_id, DB_LEASE_TTL):
+        yield False
+        return
+
+    heartbeat = asyncio.create_task(_keep_db_lease(storage, db_id, worker_id))
+    try:
+        yield True
+    finally:
+        heartbeat.cancel()
+        await storage.release_db_lease(db_id, worker_id)
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TickReport:
+    finished: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+
+class WorkerPool:
+    """Runs keyed jobs with bounded concurrency.
+
+    The pool outlives a single tick: a job whose key is still in flight from an earlier,
+    overrunning tick is skipped instead of running twice, and all ticks share one limit.
+    A job returning False, having had nothing to do, is counted as skipped too.
+    """
+
+    def __init__(self, concurrency: int):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_flight: set[str] = set()
+
+    def is_running(self, key: str) -> bool:
+        return key in self._in_flight
+
+    async def run(self, jobs: dict[str, Callable[[], Awaitable[Any]]]) -> TickReport:
+        report = TickReport()
+        keys, tasks = [], []
+        for key, job in jobs.items():
+            if key in self._in_flight:
+                report.skipped += 1
+                continue
+            self._in_flight.add(key)
+            keys.append(key)
+            tasks.append(asyncio.create_task(self._run_job(key, job)))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                report.failed += 1
+                logger.error(f'Job {key} failed: {repr(result)}', exc_info=result)
+            elif result is False:
+                report.skipped += 1
+            else:
+                report.finished += 1
+        return report
+
+    async def _run_job(self, key: str, job: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            async with self._semaphore:
+                return await job()
+        finally:
+            self._in_flight.discard(key)
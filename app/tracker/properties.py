@@ -0,0 +1,148 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Final, Optional
+
+UNKNOWN_PROPERTY_EMOJI: Final[str] = '🤷‍♀️'
+NO_VALUE: Final[str] = '—'
+MAX_VALUE_LENGTH: Final[int] = 300
+
+
+def shorten(any: Any, max_length: int = MAX_VALUE_LENGTH) -> str:
+    text = str(any)
+    return text if len(text) <= max_length else f"{text[:max_length - 1]}…"
+
+
+def to_user_friendly_dt(date_string: Optional[str]) -> str:
+    if not date_string:
+        return ''
+
+    if len(date_string) > 10:
+        dt = datetime.fromisoformat(date_string)
+        date_string = dt.strftime("%Y-%m-%d %l:%M%p").replace(":00", "").strip()
+    return date_string
+
+
+def format_plain_text(content: list) -> str:
+    return ''.join(text['plain_text'] for text in content) if content else ''
+
+
+def format_option(content: Optional[dict]) -> str:
+    return content['name'] if content else ''
+
+
+def format_date(content: Optional[dict]) -> str:
+    start = to_user_friendly_dt(content['start'] if content else None)
+    end = to_user_friendly_dt(content['end'] if content else None)
+    if not end:
+        return start
+    return f'{start} to {end}'
+
+
+def format_value(content: Any) -> str:
+    return '' if content is None else str(content)
+
+
+def format_checkbox(content: bool) -> str:
+    return '✅' if content else '❌'
+
+
+def diff_values(format: Callable[[Any], str]) -> Callable[[Any, Any], Optional[tuple[str, str]]]:
+    def diff(old: Any, new: Any) -> Optional[tuple[str, str]]:
+        old_value, new_value = format(old), format(new)
+        if old_value == new_value:
+            return None
+        return shorten(old_value), shorten(new_value)
+    return diff
+
+
+def diff_members(
+    key: Callable[[dict], str],
+    label: Callable[[dict], str],
+) -> Callable[[list, list], Optional[tuple[list[str], list[str]]]]:
+    """Diff lists of members as sets, returns the removed ones in place of the old value and the added ones."""
+    def diff(old: Optional[list], new: Optional[list]) -> Optional[tuple[list[str], list[str]]]:
+        old_members = {key(member): member for member in old or []}
+        new_members = {key(member): member for member in new or []}
+        removed = [shorten(label(member)) for k, member in old_members.items() if k not in new_members]
+        added = [shorten(label(member)) for k, member in new_members.items() if k not in old_members]
+        if not removed and not added:
+            return None
+        return removed, added
+    return diff
+
+
+def diff_relation(old: Optional[list], new: Optional[list]) -> Optional[tuple[int, int]]:
+    # Notion returns only ids of related pages, so report how many got unlinked and linked
+    old_ids = {page['id'] for page in old or []}
+    new_ids = {page['id'] for page in new or []}
+    removed, added = len(old_ids - new_ids), len(new_ids - old_ids)
+    if not removed and not added:
+        return None
+    return removed, added
+
+
+def format_change(old_value: Any, new_value: Any) -> str:
+    return f'{old_value} → {new_value}'
+
+
+def format_members_change(removed: list[str], added: list[str]) -> str:
+    return ' '.join([f'+{member}' for member in added] + [f'−{member}' for member in removed])
+
+
+def format_relation_change(removed: int, added: int) -> str:
+    parts = []
+    if added:
+        parts.append(f'+{added} linked')
+    if removed:
+        parts.append(f'−{removed} unlinked')
+    return ' '.join(parts)
+
+
+@dataclass(frozen=True, slots=True)
+class PropertyDiffer:
+    emoji: str
+    diff: Callable[[Any, Any], Optional[tuple[Any, Any]]]
+    # renders what `diff` returned
+    format: Callable[[Any, Any], str] = format_change
+
+
+PROPERTY_DIFFERS: Final[dict[str, PropertyDiffer]] = {
+    'title': PropertyDiffer('🔎', diff_values(format_plain_text)),
+    'rich_text': PropertyDiffer('📝', diff_values(format_plain_text)),
+    'status': PropertyDiffer('🚦', diff_values(format_option)),
+    'select': PropertyDiffer('🚦', diff_values(format_option)),
+    'multi_select': PropertyDiffer(
+        '🏷️',
+        diff_members(key=lambda option: option['name'], label=lambda option: option['name']),
+        format_members_change,
+    ),
+    'date': PropertyDiffer('📅', diff_values(format_date)),
+    'people': PropertyDiffer(
+        '🦹‍♀️',
+        diff_members(key=lambda person: person['id'], label=lambda person: person.get('name', '')),
+        format_members_change,
+    ),
+    'relation': PropertyDiffer('🖇️', diff_relation, format_relation_change),
+    'number': PropertyDiffer('🔢', diff_values(format_value)),
+    'checkbox': PropertyDiffer('☑️', diff_values(format_checkbox)),
+    'url': PropertyDiffer('🔗', diff_values(format_value)),
+}
+
+
+def format_property_change(property_type: Optional[str], old_value: Any, new_value: Any) -> str:
+    differ = PROPERTY_DIFFERS.get(property_type)
+    if differ is None:
+        return format_change(old_value, new_value)
+    return differ.format(old_value, new_value)
+
+
+def compose_property_diff(old: Any, new: Any) -> Optional[tuple[str, Any, Any]]:
+    """Emoji, old and new value of a changed property, None if nothing visible changed."""
+    differ = PROPERTY_DIFFERS.get(old.type)
+    if differ is None:
+        return UNKNOWN_PROPERTY_EMOJI, 'unknown', 'unknown'
+
+    values = differ.diff(old.content, new.content)
+    if values is None:
+        return None
+    return differ.emoji, *values
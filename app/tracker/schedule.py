@@ -0,0 +1,36 @@
+import time
+from typing import Final
+
+from app.storage import Storage
+
+MIN_POLL_INTERVAL: Final[int] = 15
+MAX_POLL_INTERVAL: Final[int] = 15 * 60
+POLL_BACKOFF_FACTOR: Final[int] = 2
+POLL_BATCH_SIZE: Final[int] = 1000
+
+
+async def get_due_db_ids(storage: Storage, limit: int = POLL_BATCH_SIZE) -> list[str]:
+    """Databases whose next poll is due, only those are looked at on a tick."""
+    return await storage.get_due_db_poll_ids(time.time(), limit)
+
+
+async def is_db_poll_due(storage: Storage, db_id: str) -> bool:
+    due_at = await storage.get_db_poll_due_time(db_id)
+    return due_at is not None and due_at <= time.time()
+
+
+async def reschedule_db_poll(storage: Storage, db_id: str, has_changes: bool) -> None:
+    if has_changes:
+        interval = MIN_POLL_INTERVAL
+    else:
+        interval = await storage.get_db_poll_interval(db_id) or MIN_POLL_INTERVAL
+        interval = min(interval * POLL_BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+    await storage.set_db_poll_schedule(db_id, time.time() + interval, interval)
+
+
+async def wake_db_poll(storage: Storage, db_id: str) -> None:
+    await storage.set_db_poll_schedule(db_id, time.time(), MIN_POLL_INTERVAL)
+
+
+async def unschedule_db_poll(storage: Storage, db_id: str) -> None:
+    await storage.remove_db_poll_schedule(db_id)
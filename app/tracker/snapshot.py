@@ -0,0 +1,158 @@
+from typing import AsyncIterable, AsyncIterator, Final, Iterable, Optional
+
+from app.storage import Storage
+
+SNAPSHOT_BATCH_SIZE: Final[int] = 500
+
+
+def snapshot_key(record: dict) -> tuple[str, str]:
+    """Snapshots are ordered by this key, created_time never changes so neither does the position."""
+    return record['created_time'], record['id']
+
+
+async def iter_records(records: Iterable[dict]) -> AsyncIterator[dict]:
+    for record in records:
+        yield record
+
+
+async def iter_db_state(
+    storage: Storage,
+    db_id: str,
+    batch_size: int = SNAPSHOT_BATCH_SIZE,
+) -> AsyncIterator[dict]:
+    """Yield the stored snapshot in snapshot order, holding one batch of records in memory at a time."""
+    after = None
+    while entries := await storage.get_db_page_index_range(db_id, after, batch_size):
+        page_ids = [entry.split('|', 1)[1] for entry in entries]
+        records = await storage.get_db_pages(db_id, page_ids)
+        for page_id in page_ids:
+            if page_id in records:
+                yield records[page_id]
+        after = entries[-1]
+
+
+async def pair_db_records(
+    storage: Storage,
+    db_id: str,
+    pages: list[dict],
+    removed_page_ids: list[str],
+) -> AsyncIterator[tuple[Optional[dict], Optional[dict]]]:
+    """Pair refetched pages with their stored records, reading only those from the snapshot.
+
+    Removed pages are paired with None, like in `join_db_states`.
+    """
+    old_records = await storage.get_db_pages(db_id, [page['id'] for page in pages] + removed_page_ids)
+    for page in pages:
+        yield old_records.get(page['id']), page
+    for page_id in removed_page_ids:
+        if page_id in old_records:
+            yield old_records[page_id], None
+
+
+async def sort_by_snapshot_key(records: AsyncIterable[dict]) -> AsyncIterator[dict]:
+    """Order records sorted by created_time only by the full snapshot key.
+
+    Notion can sort by created_time but not by id, and created_time has minute precision,
+    so only the records sharing a minute are buffered and sorted by id.
+    """
+    group: list[dict] = []
+    async for record in records:
+        if group and record['created_time'] != group[0]['created_time']:
+            for grouped_record in sorted(group, key=snapshot_key):
+                yield grouped_record
+            group = []
+        group.append(record)
+    for grouped_record in sorted(group, key=snapshot_key):
+        yield grouped_record
+
+
+async def join_db_states(
+    old: AsyncIterator[dict],
+    new: AsyncIterator[dict],
+) -> AsyncIterator[tuple[Optional[dict], Optional[dict]]]:
+    """Merge-join two snapshots sorted by `snapshot_key`, pairing up the records of the same page.
+
+    A page only in the old snapshot is paired with None and vice versa.
+    """
+    old_record = await anext(old, None)
+    new_record = await anext(new, None)
+    while old_record is not None or new_record is not None:
+        if new_record is None or (
+            old_record is not None and snapshot_key(old_record) < snapshot_key(new_record)
+        ):
+            yield old_record, None
+            old_record = await anext(old, None)
+        elif old_record is None or snapshot_key(new_record) < snapshot_key(old_record):
+            yield None, new_record
+            new_record = await anext(new, None)
+        else:
+            yield old_record, new_record
+            old_record = await anext(old, None)
+            new_record = await anext(new, None)
+
+
+class SnapshotConflict(Exception):
+    """Another sync claimed the snapshot, whatever this one still had to write is dropped."""
+
+
+class DbStateWriter:
+    """Buffers updates of single pages of a snapshot and writes them out in batches.
+
+    Change events emitted along are written in the same batch as the pages they are about.
+    Writes are made with the version from `Storage.claim_db_state`, once another sync claims the
+    snapshot they fail with `SnapshotConflict`, so overlapping syncs never interleave their
+    writes. Whatever was flushed before stays, it is the state the other sync starts from.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        db_id: str,
+        version: int,
+        batch_size: int = SNAPSHOT_BATCH_SIZE,
+    ):
+        self._storage = storage
+        self._db_id = db_id
+        self._version = version
+        self._batch_size = batch_size
+        self._updated: list[dict] = []
+        self._removed: list[dict] = []
+        self._events: list[dict] = []
+        self.high_water_mark: Optional[str] = None
+
+    def emit(self, event: dict) -> None:
+        self._events.append(event)
+
+    async def write(self, record: dict) -> None:
+        # ISO 8601 timestamps in the same timezone compare correctly as strings
+        if self.high_water_mark is None or record['last_edited_time'] > self.high_water_mark:
+            self.high_water_mark = record['last_edited_time']
+        self._updated.append(record)
+        if len(self._updated) >= self._batch_size:
+            await self.flush()
+
+    async def remove(self, record: dict) -> None:
+        self._removed.append(record)
+        if len(self._removed) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        is_written = await self._storage.write_db_pages(
+            self._db_id, self._version, self._updated, self._removed, self._events,
+        )
+        if not is_written:
+            raise SnapshotConflict(self._db_id)
+        self._updated, self._removed, self._events = [], [], []
+
+    async def commit(
+        self,
+        tracked_properties: list[str],
+        high_water_mark: Optional[str],
+        last_full_sync: Optional[float],
+    ) -> None:
+        await self.flush()
+        is_committed = await self._storage.commit_db_state(
+            self._db_id, self._version, tracked_properties, high_water_mark, last_full_sync,
+        )
+        if not is_committed:
+            raise SnapshotConflict(self._db_id)
@@ -1,18 +1,36 @@
 import asyncio
+import hashlib
+import json
 import logging
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Final, Iterable, Optional
 
 from aiohttp.web import Application
-from httpx import ReadTimeout
-from notion_client.errors import APIResponseError
-
-from app.notion import NotionClient
-from app.tracker.entities import Page, PageChange, PropertyChange
-from app.tracker.compose_message import (
-    compose_page_added,
-    compose_page_change,
-    compose_page_removed,
-    compose_property_diff,
+from notion_client.errors import APIErrorCode, APIResponseError, RequestTimeoutError
+
+from app.notion import AsyncNotionClient
+from app.storage import Storage, UserProfile
+from app.tracker.entities import Page, PageChange, PropertyChange, Subscriber
+from app.tracker.events import PAGE_ADDED, PAGE_CHANGED, PAGE_REMOVED, encode_event
+from app.tracker.lease import db_lease
+from app.tracker.schedule import (
+    MAX_POLL_INTERVAL,
+    get_due_db_ids,
+    is_db_poll_due,
+    reschedule_db_poll,
+    unschedule_db_poll,
+)
+from app.tracker.snapshot import (
+    DbStateWriter,
+    SnapshotConflict,
+    iter_db_state,
+    join_db_states,
+    pair_db_records,
+    sort_by_snapshot_key,
 )
+from app.tracker.properties import compose_property_diff
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,130 +38,466 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+QUERY_PAGE_SIZE: Final[int] = 100
+QUERY_PREFETCH_BATCHES: Final[int] = 2
+# deletions are invisible to delta polling, so the whole database is re-read this often, many
+# polls apart even for an idle database backed off to the longest interval
+FULL_RECONCILIATION_INTERVAL: Final[int] = 8 * MAX_POLL_INTERVAL
+# single key snapshots held only the first batch the database query returned
+LEGACY_QUERY_PAGE_SIZE: Final[int] = 100
+# last_edited_time is rounded to the minute, a page can still change without it moving
+# until that minute has passed, this also leaves room for clock skew
+LAST_EDITED_TIME_SETTLE_DELAY: Final[timedelta] = timedelta(minutes=2)
+# errors meaning the subscriber's token can't read the database anymore
+DETACHING_ERROR_CODES: Final[frozenset[str]] = frozenset({
+    APIErrorCode.ObjectNotFound,
+    APIErrorCode.Unauthorized,
+    APIErrorCode.RestrictedResource,
+})
 
-def track_db_changes(old: list[Page], new: list[Page], tracked_properties: list[str]):
-    # get page id lists for old and new
-    old_ids = [page.id for page in old] if old else []
-    new_ids = [page.id for page in new]
 
-    # get added and possibly changed pages from new list
-    added_page_ids = [page_id for page_id in new_ids if page_id not in old_ids]
-    logger.info(f'Added: {added_page_ids}')
-    added_pages = []
-    changed_pages_from_new = []
-    for page in new:
-        if page.id in added_page_ids:
-            added_pages.append(page)
-        else:
-            changed_pages_from_new.append(page)
-
-    # get removed and possibly changed pages from old list
-    removed_page_ids = [page_id for page_id in old_ids if page_id not in new_ids]
-    logger.info(f'Removed: {removed_page_ids}')
-    removed_pages = []
-    changed_pages_from_old = []
-    for page in old:
-        if page.id in removed_page_ids:
-            removed_pages.append(page)
+def get_page_title(properties: dict) -> Optional[str]:
+    for prop in properties.values():
+        if prop['type'] == 'title' and prop['title']:
+            return prop['title'][0]['plain_text']
+    return None
+
+
+def project_page(page: dict, tracked_properties: Iterable[str]) -> dict:
+    """Strip a Notion page down to what is diffed and rendered, the snapshot stores only this."""
+    properties = page['properties']
+    return {
+        'id': page['id'],
+        'created_time': page['created_time'],
+        'last_edited_time': page['last_edited_time'],
+        'url': page['url'],
+        'title': get_page_title(properties),
+        'properties': {
+            name: properties[name] for name in tracked_properties if name in properties
+        },
+    }
+
+
+async def iter_db_pages(
+    notion: AsyncNotionClient,
+    db_id: str,
+    tracked_properties: Iterable[str],
+    **query: Any,
+) -> AsyncIterator[dict]:
+    async for page in notion.iter_pages(
+        db_id,
+        page_size=QUERY_PAGE_SIZE,
+        prefetch=QUERY_PREFETCH_BATCHES,
+        **query,
+    ):
+        yield project_page(page, tracked_properties)
+
+
+def iter_db_snapshot(
+    notion: AsyncNotionClient,
+    db_id: str,
+    tracked_properties: Iterable[str],
+) -> AsyncIterator[dict]:
+    """Stream the whole database in snapshot order."""
+    return sort_by_snapshot_key(
+        iter_db_pages(
+            notion,
+            db_id,
+            tracked_properties,
+            sorts=[{'timestamp': 'created_time', 'direction': 'ascending'}],
+        )
+    )
+
+
+async def fetch_db_delta(
+    notion: AsyncNotionClient,
+    db_id: str,
+    tracked_properties: Iterable[str],
+    since: str,
+) -> list[dict]:
+    # last_edited_time has minute precision, so pages edited at the mark itself are refetched
+    return [
+        page
+        async for page in iter_db_pages(
+            notion,
+            db_id,
+            tracked_properties,
+            filter={
+                'timestamp': 'last_edited_time',
+                'last_edited_time': {'on_or_after': since},
+            },
+            sorts=[{'timestamp': 'last_edited_time', 'direction': 'ascending'}],
+        )
+    ]
+
+
+async def fetch_pages_by_id(
+    notion: AsyncNotionClient,
+    db_id: str,
+    tracked_properties: Iterable[str],
+    page_ids: list[str],
+) -> tuple[list[dict], list[str]]:
+    """Refetch single pages, returns the pages still in the database and the ids of the gone ones."""
+    pages, removed_page_ids = [], []
+    for page_id in page_ids:
+        try:
+            page = await notion.pages.retrieve(page_id)
+        except APIResponseError as e:
+            if e.code != APIErrorCode.ObjectNotFound:
+                raise
+            removed_page_ids.append(page_id)
+            continue
+
+        if page.get('archived') or page['parent'].get('database_id') != db_id:
+            removed_page_ids.append(page_id)
         else:
-            changed_pages_from_old.append(page)
-
-    # track changes in properties of new and old
-    sorted_old = sorted(changed_pages_from_old, key=lambda page: page.id)
-    sorted_new = sorted(changed_pages_from_new, key=lambda page: page.id)
-
-    db_changes = []
-    for old_page, new_page in zip(sorted_old, sorted_new):
-        old_page_props = [property for property in old_page.properties if property.name in tracked_properties]
-        new_page_props = [property for property in new_page.properties if property.name in tracked_properties]
-        page_property_changes = []
-        for old_property, new_property in zip(old_page_props, new_page_props):
-            try:
-                if old_property.content != new_property.content:
-                    emoji, old_value, new_value = compose_property_diff(old_property, new_property)
-                    page_property_changes.append(PropertyChange(old_property.name, old_value, new_value, emoji))
-            except Exception as ex:
-                logger.error(
-                    f'Error while tracking changes in property {old_property.name}: {repr(ex)}'
-                )
-                continue
-
-        if page_property_changes:
-            db_changes.append(
-                PageChange(
-                    old_page.name,
-                    old_page.url,
-                    page_property_changes,
-                )
+            pages.append(project_page(page, tracked_properties))
+    return pages, removed_page_ids
+
+
+def get_high_water_mark(pages: list[dict], current: Optional[str] = None) -> Optional[str]:
+    # ISO 8601 timestamps in the same timezone compare correctly as strings
+    return max((page['last_edited_time'] for page in pages), default=current)
+
+
+def fingerprint_page(page: dict, tracked_properties: list[str]) -> str:
+    properties = page['properties']
+    tracked_content = {name: properties[name] for name in tracked_properties if name in properties}
+    payload = json.dumps(tracked_content, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def is_page_settled(old_record: dict, new_record: dict, settled_before: str) -> bool:
+    """Whether an unchanged last_edited_time proves the page is unchanged, so hashing can be skipped.
+
+    A newly tracked property isn't in the stored record yet, so such a page is never settled.
+    """
+    return (
+        'fingerprint' in old_record
+        and old_record['last_edited_time'] == new_record['last_edited_time']
+        and new_record['last_edited_time'] < settled_before
+        and new_record['properties'].keys() <= old_record['properties'].keys()
+    )
+
+
+def diff_page(old_page: Page, new_page: Page, tracked_properties: list[str]) -> Optional[PageChange]:
+    # pair properties by their id, which survives renames and reordering of the schema
+    page_property_changes = []
+    for name in tracked_properties:
+        new_property = new_page.get_property(name)
+        if new_property is None:
+            continue
+        old_property = old_page.get_property_by_id(new_property.id)
+        if old_property is None or old_property.type != new_property.type:
+            # a new or retyped property has nothing comparable to diff against
+            continue
+        try:
+            if old_property.content != new_property.content:
+                property_diff = compose_property_diff(old_property, new_property)
+                if property_diff:
+                    emoji, old_value, new_value = property_diff
+                    page_property_changes.append(
+                        PropertyChange(new_property.name, old_value, new_value, emoji, new_property.type)
+                    )
+        except Exception as ex:
+            logger.error(
+                f'Error while tracking changes in property {new_property.name}: {repr(ex)}'
             )
-    return db_changes, added_pages, removed_pages
+            continue
 
+    if not page_property_changes:
+        return None
+    return PageChange(old_page.name, old_page.url, page_property_changes)
+
+
+async def track_db_changes(
+    pairs: AsyncIterator[tuple[Optional[dict], Optional[dict]]],
+    writer: DbStateWriter,
+    tracked_properties: list[str],
+) -> AsyncIterator[tuple[str, Any]]:
+    """Diff pairs of stored and fetched records of the same page, writing out only what changed.
+
+    Yields (PAGE_ADDED, Page), (PAGE_REMOVED, Page) and (PAGE_CHANGED, PageChange) events as soon
+    as they are found, so only the pages being compared are held in memory. An event is yielded
+    before its page is handed to the writer, so the caller can emit it into the same batch.
+    """
+    tracked_properties = list(dict.fromkeys(tracked_properties))
+    settled_before = (datetime.now(timezone.utc) - LAST_EDITED_TIME_SETTLE_DELAY).strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z'
+    )
+    async for old_record, new_record in pairs:
+        if new_record is None:
+            yield PAGE_REMOVED, Page.from_json(old_record)
+            await writer.remove(old_record)
+            continue
+
+        if old_record is not None and is_page_settled(old_record, new_record, settled_before):
+            continue
+
+        new_record['fingerprint'] = fingerprint_page(new_record, tracked_properties)
+        if old_record is None:
+            yield PAGE_ADDED, Page.from_json(new_record)
+            await writer.write(new_record)
+            continue
+
+        is_changed = old_record.get('fingerprint') != new_record['fingerprint']
+        if is_changed:
+            page_change = diff_page(
+                Page.from_json(old_record), Page.from_json(new_record), tracked_properties,
+            )
+            if page_change:
+                yield PAGE_CHANGED, page_change
+        # an edit of an untracked property is stored too, so the page settles again
+        if is_changed or old_record['last_edited_time'] != new_record['last_edited_time']:
+            await writer.write(new_record)
 
-async def track_changes(app: Application, user_chat_id: int):
-    storage = app['storage']
-    bot = app['bot']
 
-    chat_id = await storage.get_user_notification_chat_id(user_chat_id)
-    if not chat_id:
+async def migrate_db_state(storage: Storage, db_id: str) -> bool:
+    """Move a snapshot stored in a single key over to the per-page layout, returns whether it was kept.
+
+    The single key holds the raw pages of the first query batch, every property of them is kept.
+    A full batch may miss the rest of the database, whose pages would all be reported as added
+    on the next sync, so it is dropped instead and the next sync takes a fresh baseline.
+    """
+    pages = await storage.get_legacy_db_state(db_id)
+    is_kept = (
+        bool(pages)
+        and len(pages) < LEGACY_QUERY_PAGE_SIZE
+        # a snapshot taken since by the tracker is newer
+        and not await storage.has_db_state(db_id)
+    )
+    if is_kept:
+        tracked_properties = sorted(set.intersection(*(set(page['properties']) for page in pages)))
+        writer = DbStateWriter(storage, db_id, await storage.claim_db_state(db_id))
+        try:
+            for page in pages:
+                await writer.write(project_page(page, tracked_properties))
+            # never fully synced in this layout, so the next sync is a full one
+            await writer.commit(tracked_properties, writer.high_water_mark, None)
+        except SnapshotConflict:
+            logger.info(f'Migration of {db_id} was taken over by a tracker sync')
+            is_kept = False
+    await storage.delete_legacy_db_state(db_id)
+    return is_kept
+
+
+async def is_full_sync_due(storage: Storage, db_id: str) -> bool:
+    last_full_sync = await storage.get_db_last_full_sync(db_id)
+    if last_full_sync is None:
+        return True
+    return time.time() - last_full_sync >= FULL_RECONCILIATION_INTERVAL
+
+
+def make_subscriber(user_chat_id: int, profile: UserProfile) -> Optional[Subscriber]:
+    if not profile.notification_chat_id:
         logger.warning(
             f'No notification chat id found for {user_chat_id}! Skipping...'
         )
+        return None
 
-    access_token = await storage.get_user_access_token(user_chat_id)
-    db_id = await storage.get_user_db_id(user_chat_id)
-    track_props = await storage.get_user_tracked_properties(user_chat_id)
-
-    if not access_token or not db_id or not track_props:
+    if not profile.access_token or not profile.db_id or not profile.tracked_properties:
         logger.warning(f'Setup not completed for {user_chat_id}! Skipping...')
-        return
+        return None
+    return Subscriber(
+        user_chat_id,
+        profile.notification_chat_id,
+        profile.access_token,
+        profile.db_id,
+        list(profile.tracked_properties),
+    )
+
+
+async def load_subscribers_by_db(storage: Storage, user_chat_ids: list[int]) -> dict[str, list[Subscriber]]:
+    """Load every subscriber in a few pipelined round trips, grouped by the database they track."""
+    subscribers_by_db: dict[str, list[Subscriber]] = {}
+    profiles = await storage.get_user_profiles(user_chat_ids)
+    for user_chat_id, profile in profiles.items():
+        subscriber = make_subscriber(user_chat_id, profile)
+        if subscriber:
+            subscribers_by_db.setdefault(subscriber.db_id, []).append(subscriber)
+    return subscribers_by_db
 
-    notion = NotionClient(auth=access_token)
-    old_db_state = await storage.get_user_db_state(db_id)
+
+async def load_db_subscribers(
+    storage: Storage,
+    subscriber_ids: dict[str, list[int]],
+) -> dict[str, list[Subscriber]]:
+    """Load the subscribers of the given databases who have notifications on."""
+    chat_ids = sorted({chat_id for chat_ids in subscriber_ids.values() for chat_id in chat_ids})
+    active_chat_ids = await storage.filter_active_notification_chat_ids(chat_ids)
+    subscribers_by_db = await load_subscribers_by_db(storage, active_chat_ids)
+    return {db_id: subscribers_by_db[db_id] for db_id in subscriber_ids if db_id in subscribers_by_db}
+
+
+async def detach_subscriber(app: Application, subscriber: Subscriber) -> None:
+    await app['storage'].remove_user_db_id(subscriber.chat_id)
+    await app['telegram'].send_message(
+        subscriber.chat_id,
+        "Oops, we haven't found your database in Notion 😢\n"
+        "Did you do something with it!?\n\n"
+        "Try to reconnect your workspace with /connect command 🥺",
+    )
+
+
+async def sync_db(
+    storage: Storage,
+    notion: AsyncNotionClient,
+    db_id: str,
+    tracked_properties: list[str],
+    dirty_page_ids: list[str],
+) -> bool:
+    """Diff the database against its snapshot, appending what changed to its event stream.
+
+    Events are delivered to the subscribers by `app.tracker.delivery`.
+    """
+    # claimed before anything is read, so no write of an older sync can slip in after the reads
+    version = await storage.claim_db_state(db_id)
+    has_db_state = await storage.has_db_state(db_id)
+    high_water_mark = await storage.get_db_high_water_mark(db_id)
+    # a newly tracked property is missing from the snapshot, a full pass fills it in everywhere
+    # and, with nothing to compare against, it is only reported from the next change on
+    state_properties = await storage.get_db_state_properties(db_id)
+    is_full_sync = (
+        not has_db_state
+        or not high_water_mark
+        or state_properties is None
+        or not set(tracked_properties).issubset(state_properties)
+        or await is_full_sync_due(storage, db_id)
+    )
+
+    if is_full_sync:
+        pairs = join_db_states(
+            iter_db_state(storage, db_id),
+            iter_db_snapshot(notion, db_id, tracked_properties),
+        )
+    else:
+        # only refetched pages can differ, removals are known only from change events
+        removed_page_ids = []
+        if dirty_page_ids:
+            # single page refetches say nothing about the rest, so the delta must still cover it
+            fetched_pages, removed_page_ids = await fetch_pages_by_id(
+                notion, db_id, tracked_properties, dirty_page_ids,
+            )
+        else:
+            fetched_pages = await fetch_db_delta(notion, db_id, tracked_properties, high_water_mark)
+            high_water_mark = get_high_water_mark(fetched_pages, high_water_mark)
+        pairs = pair_db_records(storage, db_id, fetched_pages, removed_page_ids)
+
+    has_changes = False
+    writer = DbStateWriter(storage, db_id, version)
     try:
-        new_db_state = notion.databases.query(database_id=db_id)
-    except APIResponseError as e:
-        logger.error(f'Error while querying database {db_id}: {repr(e)}')
-        await storage.remove_user_db_id(user_chat_id)
-        await bot.send_message(
-            user_chat_id,
-            "Oops, we haven't found your database in Notion 😢\n"
-            "Did you do something with it!?\n\n"
-            "Try to reconnect your workspace with /connect command 🥺",
+        async for event, item in track_db_changes(pairs, writer, tracked_properties):
+            # nothing to compare against yet, the first snapshot only sets the baseline
+            if has_db_state:
+                has_changes = True
+                writer.emit(encode_event(event, item))
+                logger.info(f'Page {event}: {item}')
+
+        if is_full_sync:
+            # pages left unwritten were not edited since the previous mark
+            high_water_mark = max(filter(None, (writer.high_water_mark, high_water_mark)), default=None)
+        await writer.commit(
+            # only properties present in every record count as captured by the snapshot
+            tracked_properties if is_full_sync else sorted(set(state_properties) & set(tracked_properties)),
+            high_water_mark,
+            time.time() if is_full_sync else None,
         )
-        return
-    except ReadTimeout as e:
-        logger.error(f'Took too long to track changes for {db_id}: {repr(e)}')
-        return
+        await storage.remove_db_dirty_page_ids(db_id, dirty_page_ids)
+    except SnapshotConflict:
+        logger.info(f'Snapshot of {db_id} was taken over by another sync, leaving it to that one')
+    return has_changes
+
+
+async def track_changes(app: Application, db_id: str, subscribers: list[Subscriber]) -> bool:
+    """Fetch and diff the database once and notify every subscriber about their tracked properties.
+
+    Returns whether anything changed, so the poll interval can be adapted.
+    """
+    storage = app['storage']
+
+    tracked_properties = sorted({
+        prop for subscriber in subscribers for prop in subscriber.tracked_properties
+    })
+    # pages reported by Notion change events are refetched one by one instead of polling,
+    # they stay marked until a sync has committed them
+    dirty_page_ids = await storage.get_db_dirty_page_ids(db_id)
+
+    # any subscriber's token can read the database, fall back to the next one if it was revoked
+    subscribers = list(subscribers)
+    while subscribers:
+        notion = AsyncNotionClient(
+            auth=subscribers[0].access_token,
+            rate_limiter=app['notion_rate_limiter'],
+        )
+        try:
+            return await sync_db(
+                storage,
+                notion,
+                db_id,
+                tracked_properties,
+                dirty_page_ids,
+            )
+        except APIResponseError as e:
+            logger.error(f'Error while querying database {db_id}: {repr(e)}')
+            if e.code not in DETACHING_ERROR_CODES:
+                # not the token's fault, the next tick retries
+                return False
+            await detach_subscriber(app, subscribers.pop(0))
+        except RequestTimeoutError as e:
+            logger.error(f'Took too long to track changes for {db_id}: {repr(e)}')
+            return False
+        finally:
+            await notion.aclose()
+    return False
 
-    old = [Page.from_json(page) for page in old_db_state]
-    new = [Page.from_json(page) for page in new_db_state['results']]
-    changes, added_pages, removed_pages = track_db_changes(old, new, track_props)
-    await storage.set_user_db_state(db_id, new_db_state)
 
-    for page in added_pages:
-        added_message, parse_mode = compose_page_added(page)
-        await bot.send_message(chat_id, added_message, parse_mode=parse_mode)
+async def poll_database(app: Application, db_id: str, subscribers: list[Subscriber]) -> bool:
+    storage = app['storage']
+    async with db_lease(storage, db_id, app['worker_id']) as acquired:
+        # another worker may have polled and rescheduled it since the due check
+        if not acquired or not await is_db_poll_due(storage, db_id):
+            return False
+        has_changes = False
+        try:
+            has_changes = await track_changes(app, db_id, subscribers)
+        finally:
+            # a poll that failed is backed off like an unchanged one instead of staying due
+            await reschedule_db_poll(storage, db_id, has_changes)
+        return True
 
-    for page in removed_pages:
-        removed_message, parse_mode = compose_page_removed(page)
-        await bot.send_message(chat_id, removed_message, parse_mode=parse_mode)
 
-    for page_change in changes:
-        change_message, parse_mode = compose_page_change(page_change)
-        await bot.send_message(chat_id, change_message, parse_mode=parse_mode)
-    logger.info(f'Changes for {chat_id}: {changes}')
+async def run_tracker_jobs(app: Application, jobs: dict[str, Callable[[], Awaitable[Any]]]) -> None:
+    report = await app['tracker_pool'].run(jobs)
+    logger.info(
+        f'Tick done: {report.finished} finished, {report.failed} failed, '
+        f'{report.skipped} skipped'
+    )
 
 
 async def track_changes_for_all(app: Application):
     storage = app['storage']
 
     logger.info('Tracking changes for all users...')
-    active_notification_chat_ids = await storage.get_all_active_notification_chat_ids()
-    if not active_notification_chat_ids:
-        logger.warning('No chat ids found!')
+    due_db_ids = await get_due_db_ids(storage)
+    if not due_db_ids:
         return
 
-    tasks = []
-    for user_chat_id in active_notification_chat_ids:
-        tasks.append(asyncio.create_task(track_changes(app, user_chat_id)))
-    asyncio.gather(*tasks)
+    subscriber_ids = await storage.get_db_subscriber_ids(due_db_ids)
+    subscribers_by_db = await load_db_subscribers(storage, subscriber_ids)
+    for db_id in due_db_ids:
+        if not subscriber_ids[db_id]:
+            # choosing the database again schedules it
+            await unschedule_db_poll(storage, db_id)
+        elif db_id not in subscribers_by_db:
+            # everyone paused, looked at again less and less often until someone unpauses
+            await reschedule_db_poll(storage, db_id, False)
+
+    jobs = {
+        db_id: partial(poll_database, app, db_id, subscribers)
+        for db_id, subscribers in subscribers_by_db.items()
+    }
+    # the tick returns right away, so a slow database doesn't hold up the next one, databases
+    # still syncing from an earlier tick are skipped by the pool
+    run = asyncio.create_task(run_tracker_jobs(app, jobs))
+    app['tracker_runs'].add(run)
+    run.add_done_callback(app['tracker_runs'].discard)
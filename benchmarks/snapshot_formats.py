@@ -0,0 +1,118 @@
+"""Compares snapshot encodings by encode/decode time and bytes stored.
+
+Snapshots are stored as one encoded value per page, so every page is encoded on its own, as
+`Storage.write_db_pages` does. The legacy format is the whole database as a single JSON value.
+
+    python -m benchmarks.snapshot_formats
+"""
+import json
+import random
+import time
+import uuid
+from typing import Callable
+
+from app.storage import (
+    COMPRESSIONS,
+    JSONSerializer,
+    MsgpackSerializer,
+    NoCompression,
+    SnapshotCodec,
+    ZlibCompression,
+    ZstdCompression,
+)
+
+DB_SIZES = (100, 1_000, 10_000)
+ROUNDS = 5
+STATUSES = ['Not started', 'In progress', 'In review', 'Done', 'Blocked']
+PEOPLE = [
+    {'object': 'user', 'id': str(uuid.uuid4()), 'name': name, 'avatar_url': None, 'type': 'person'}
+    for name in ('Alice', 'Bob', 'Carol', 'Dave', 'Eve')
+]
+
+
+def make_rich_text(text: str) -> list[dict]:
+    return [{
+        'type': 'text',
+        'text': {'content': text, 'link': None},
+        'annotations': {
+            'bold': False, 'italic': False, 'strikethrough': False,
+            'underline': False, 'code': False, 'color': 'default',
+        },
+        'plain_text': text,
+        'href': None,
+    }]
+
+
+def make_page(index: int) -> dict:
+    """A snapshot record as the tracker stores it, with a typical set of tracked properties."""
+    page_id = str(uuid.uuid4())
+    title = f'Task {index}: {random.choice(["Fix", "Build", "Review", "Ship"])} the thing'
+    status = random.choice(STATUSES)
+    return {
+        'id': page_id,
+        'created_time': f'2023-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}.000Z',
+        'last_edited_time': f'2023-0{random.randint(1, 9)}-1{random.randint(0, 9)}T10:{index % 60:02d}:00.000Z',
+        'url': f"https://www.notion.so/{title.replace(' ', '-')}-{page_id.replace('-', '')}",
+        'title': title,
+        'properties': {
+            'Name': {'id': 'title', 'type': 'title', 'title': make_rich_text(title)},
+            'Status': {
+                'id': 'k%3F%5D',
+                'type': 'status',
+                'status': {'id': str(uuid.uuid4()), 'name': status, 'color': 'blue'},
+            },
+            'Assignee': {
+                'id': 'notion%3A%2F%2Ftasks%2Fassign_property',
+                'type': 'people',
+                'people': random.sample(PEOPLE, random.randint(0, 2)),
+            },
+            'Due': {
+                'id': 'notion%3A%2F%2Ftasks%2Fdue_date_property',
+                'type': 'date',
+                'date': {'start': f'2023-10-{random.randint(10, 28)}', 'end': None, 'time_zone': None},
+            },
+        },
+    }
+
+
+def measure(func: Callable[[], object]) -> float:
+    best = float('inf')
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main() -> None:
+    codecs = {
+        'json (legacy)': None,
+        'json+zlib': SnapshotCodec(JSONSerializer(), ZlibCompression()),
+        'msgpack': SnapshotCodec(MsgpackSerializer(), NoCompression()),
+        'msgpack+zlib': SnapshotCodec(MsgpackSerializer(), ZlibCompression()),
+    }
+    if ZstdCompression.code in COMPRESSIONS:
+        codecs['msgpack+zstd'] = SnapshotCodec(MsgpackSerializer(), ZstdCompression())
+
+    random.seed(42)
+    print(f"{'pages':>7} {'codec':<14} {'bytes':>11} {'encode ms':>10} {'decode ms':>10}")
+    for db_size in DB_SIZES:
+        db_state = [make_page(index) for index in range(db_size)]
+        for name, codec in codecs.items():
+            if codec is None:
+                encode = lambda: [json.dumps(db_state).encode('utf-8')]
+                decode = lambda data: json.loads(data[0])
+            else:
+                encode = lambda: [codec.encode(record) for record in db_state]
+                decode = lambda data: [codec.decode(value) for value in data]
+
+            data = encode()
+            assert decode(data) == db_state
+            print(
+                f'{db_size:>7} {name:<14} {sum(map(len, data)):>11,} '
+                f'{measure(encode):>10.2f} {measure(lambda: decode(data)):>10.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()